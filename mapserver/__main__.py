@@ -20,51 +20,71 @@
 
 import asyncio
 import os
+import secrets
 import signal
 import sys
+import tempfile
 from typing import Any
 
 #===============================================================================
 
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+import hypercorn.run
 
 import uvloop
 
 #===============================================================================
 
-from .server import app, initialise, map_maker
+from . import server
+from .maker_service import RemoteManager, serve_manager
+from .server import app, initialise
 from .settings import config, settings
 
 SERVER_INTERFACE = os.environ.get('SERVER_INTERFACE', '127.0.0.1')
 SERVER_PORT      = os.environ.get('SERVER_PORT', '8000')
 
+# Number of server processes; each worker process uses its own event loop
+
+SERVER_WORKERS   = int(os.environ.get('SERVER_WORKERS', '1'))
+
 #===============================================================================
 
 class SyncLogger:
+    """
+    Log directly to Hypercorn's error log, so that logging can be used both
+    from within a running event loop and from executor threads.
+    """
     def __init__(self, logger):
-        self.__logger = logger
+        self.__logger = logger.error_logger
 
     def critical(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.critical(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.critical(msg, *args, **kwds)
 
     def debug(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.debug(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.debug(msg, *args, **kwds)
 
     def error(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.error(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.error(msg, *args, **kwds)
 
     def exception(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.exception(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.exception(msg, *args, **kwds)
 
     def info(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.info(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.info(msg, *args, **kwds)
 
-    def log(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.log(msg, *args, **kwds))
+    def log(self, level, msg, *args, **kwds):
+        if self.__logger is not None:
+            self.__logger.log(level, msg, *args, **kwds)
 
     def warning(self, msg, *args, **kwds):
-        asyncio.run(self.__logger.warning(msg, *args, **kwds))
+        if self.__logger is not None:
+            self.__logger.warning(msg, *args, **kwds)
 
 #===============================================================================
 
@@ -73,33 +93,78 @@ __shutdown_event = asyncio.Event()
 def __signal_handler(*_: Any) -> None:
 #=====================================
     __shutdown_event.set()
-    if map_maker is not None:
-        map_maker.terminate()
+    if server.map_maker is not None:
+        server.map_maker.terminate()
 
-async def runserver(viewer=False):
-#=================================
+def configure(config: Config) -> Config:
+#=======================================
     config.bind = [f'{SERVER_INTERFACE}:{SERVER_PORT}']
     config.worker_class = 'uvloop'
     config.accesslog = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'access_log')
     config.errorlog = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'error_log')
+    return config
+
+def start_logging(config: Config):
+#=================================
     settings['LOGGER'] = config.log
     app.logger = SyncLogger(config.log)
 
+async def runserver(viewer=False):
+#=================================
+    start_logging(configure(config))
     initialise(viewer)
 
-    uvloop.install()
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGTERM, __signal_handler)
-    loop.run_until_complete(
-        serve(app, config, shutdown_trigger=__shutdown_event.wait)
-    )
+    await serve(app, config, shutdown_trigger=__shutdown_event.wait)
+
+#===============================================================================
+
+def run_workers(viewer=False):
+#=============================
+    """
+    Run ``SERVER_WORKERS`` server processes sharing the listening socket.
+
+    Workers share nothing except the annotation store and files under
+    ``FLATMAP_ROOT``. Maps are only made by this, the supervising, process,
+    with workers passing map making requests to it.
+    """
+    start_logging(configure(config))
+    initialise(viewer)
+    maker_address = os.path.join(tempfile.gettempdir(), f'mapserver-maker-{os.getpid()}.sock')
+    maker_authkey = secrets.token_hex(32)
+    if server.map_maker is not None:
+        serve_manager(server.map_maker, maker_address, maker_authkey.encode())
+    # Workers are given a copy of their configuration, which has to be
+    # picklable and so can't have an active logger
+    worker_config = configure(Config())
+    worker_config.workers = SERVER_WORKERS
+    worker_config.application_path = f'mapserver.__main__:worker_app({viewer}, {maker_address!r}, {maker_authkey!r})'
+    try:
+        hypercorn.run.run(worker_config)
+    finally:
+        if server.map_maker is not None:
+            server.map_maker.terminate()
+
+def worker_app(viewer: bool, maker_address: str, maker_authkey: str):
+#===================================================================
+    """
+    Set up the application in a worker process started by ``run_workers()``.
+    """
+    start_logging(configure(config))
+    initialise(viewer, RemoteManager(maker_address, maker_authkey.encode()))
+    return app
 
 #===============================================================================
 
 def main(viewer=False):
 #======================
     try:
-        asyncio.run(runserver(viewer))
+        if SERVER_WORKERS > 1:
+            run_workers(viewer)
+        else:
+            uvloop.install()
+            asyncio.run(runserver(viewer))
     except KeyboardInterrupt:
         pass
 
@@ -21,10 +21,16 @@
 from datetime import datetime, timezone
 from functools import wraps
 from pathlib import Path
+import asyncio
+import base64
+import itertools
 import json
+import math
 import os
 import sqlite3
-from typing import Any, Optional
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
 import uuid
 
 #===============================================================================
@@ -33,8 +39,10 @@ import quart            # type: ignore
 
 #===============================================================================
 
+from .executor import run_db, run_network, run_writer
 from .pennsieve import get_user
 from .server import annotator_blueprint, settings
+from .streaming import NDJSON_MIMETYPE, json_items, stream_in_thread
 
 #===============================================================================
 '''
@@ -106,24 +114,162 @@ ANNOTATION_STORE_SCHEMA = """
     commit;
 """
 
+# Changes to the schema of an annotation store, each a list of statements,
+# made in order when the store is opened for writing. The store's ``user_version``
+# is the number of changes already made.
+
+ANNOTATION_STORE_MIGRATIONS = [
+    # Indexes for listing annotations newest first, features that haven't
+    # been replaced, and an annotation's feature (``features.annotation``
+    # has text affinity so is indexed as an integer to match ``rowid``)
+    [
+        'create index if not exists annotations_created_index on annotations(created desc, creator)',
+        'create index if not exists annotations_resource_index on annotations(resource, created desc, creator)',
+        'create index if not exists annotations_item_index on annotations(resource, itemid, created desc, creator)',
+        'create index if not exists features_current_index on features(resource, itemid) where deleted is null',
+        'create index if not exists features_annotation_index on features(cast(annotation as integer))',
+    ],
+    # The number of the change that added, or replaced, a row, with one
+    # change for each annotation that is added
+    [
+        'create table if not exists change_sequence (last integer not null)',
+        'insert into change_sequence (last) select 0 where not exists (select * from change_sequence)',
+        'alter table annotations add column change integer',
+        'alter table features add column change integer',
+        'create index if not exists annotations_change_index on annotations(resource, change)',
+        'create index if not exists features_change_index on features(resource, change)',
+    ],
+    # Indexes for the changes to all resources
+    [
+        'create index if not exists annotations_sequence_index on annotations(change)',
+        'create index if not exists features_sequence_index on features(change)',
+    ],
+    # When a session was started and last used, with existing sessions
+    # treated as just started
+    [
+        'alter table sessions add column created real',
+        'alter table sessions add column last_used real',
+        "update sessions set created = cast(strftime('%s', 'now') as real)",
+        'update sessions set last_used = created',
+        'create index if not exists sessions_last_used_index on sessions(last_used)',
+    ],
+]
+
+# The most rows that a page of a listing may have
+
+ANNOTATION_PAGE_LIMIT = 10000
+
+# The longest, in seconds, that a request for changes may wait for one
+
+ANNOTATION_CHANGES_WAIT = 60
+
+# How often, in seconds, a waiting request for changes also looks for any
+# made by other server processes
+
+ANNOTATION_CHANGES_POLL = 2
+
+# Columns of the ``annotations`` table that make up an annotation
+
+ANNOTATION_COLUMNS = 'rowid, created, creator, annotation, resource, itemid, item'
+
+# Sessions are kept in the store so that they are valid in all server processes
+
+SESSION_STORE_SCHEMA = """
+    create table if not exists sessions (session text primary key, data text);
+"""
+
+# How long, in seconds, a session lasts after it was last used
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '86400'))
+
+# How often, in seconds, a session in use has its last use saved
+
+SESSION_TOUCH_INTERVAL = 60
+
 PROVENANCE_PROPERTIES = [
     'rdfs:comment',
     'prov:wasDerivedFrom',
 ]
 
+# The size, in KiB, of each annotation store connection's page cache
+
+ANNOTATION_STORE_CACHE_SIZE = int(os.environ.get('ANNOTATION_STORE_CACHE_SIZE', '8192'))
+
+#===============================================================================
+
+class PageError(Exception):
+    pass
+
+class Page:
+    """
+    A page of a listing, of at most ``limit`` rows, starting after the row
+    whose sort key is ``after``.
+
+    Once the page has been read, :attr:`total` is the number of rows in the
+    whole listing, and :attr:`next` is the sort key of the page's last row
+    or ``None`` if there are no more rows.
+    """
+    def __init__(self, limit: int, after: Optional[list]=None):
+        self.__limit = limit
+        self.__after = after
+        self.next: Optional[list] = None
+        self.total = 0
+
+    @property
+    def after(self) -> Optional[list]:
+        return self.__after
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
 #===============================================================================
 
 class AnnotationStore:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, read_only=False):
         if db_path is None:
             db_path = os.path.join(settings['FLATMAP_ROOT'], 'annotation_store.db')
-        # Create annotation store if it doesn't exist
-        db_name = Path(db_path).resolve()
-        if not db_name.exists():
-            db = sqlite3.connect(db_name)
-            db.executescript(ANNOTATION_STORE_SCHEMA)
-            db.close()
-        self.__db = sqlite3.connect(db_name)
+        self.__db_name = Path(db_path).resolve()
+        self.__db = None
+        if read_only:
+            if self.__db_name.exists():
+                self.__db = sqlite3.connect(self.__db_name)
+                self.__db.execute('PRAGMA query_only=ON')
+        else:
+            # Create annotation store if it doesn't exist
+            if not self.__db_name.exists():
+                db = sqlite3.connect(self.__db_name)
+                db.executescript(ANNOTATION_STORE_SCHEMA)
+                db.close()
+            self.__db = sqlite3.connect(self.__db_name)
+            # Readers don't wait for a writer, and commits only wait for
+            # the write-ahead log to be written
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.executescript(SESSION_STORE_SCHEMA)
+            self.__migrate()
+        if self.__db is not None:
+            self.__db.execute(f'PRAGMA cache_size=-{ANNOTATION_STORE_CACHE_SIZE}')
+
+    @property
+    def db_name(self) -> Path:
+        return self.__db_name
+
+    def __migrate(self):
+    #===================
+        # Another process may be migrating the store, so its version is only
+        # checked once we can write to it
+        self.__db.execute('begin immediate')        # type: ignore
+        try:
+            version = self.__db.execute('PRAGMA user_version').fetchone()[0]       # type: ignore
+            for (n, statements) in enumerate(ANNOTATION_STORE_MIGRATIONS[version:], start=version+1):
+                for statement in statements:
+                    self.__db.execute(statement)        # type: ignore
+                self.__db.execute(f'PRAGMA user_version={n}')       # type: ignore
+            self.__db.commit()                      # type: ignore
+        except sqlite3.Error:
+            self.__db.rollback()                    # type: ignore
+            raise
 
     def close(self):
     #===============
@@ -131,30 +277,60 @@ class AnnotationStore:
             self.__db.close()
             self.__db = None
 
-    def annotated_item_ids(self, resource_id: str) -> dict:
-    #======================================================
+    def __rows(self, select: str, count: str, where: list[str], values: list, order: str,
+               page: Optional[Page]=None, keyset: Optional[Callable[..., tuple[str, list]]]=None,
+               key: Optional[Callable[[tuple], list]]=None) -> list[tuple]:
+    #=============================================================================================
+        """
+        The rows of a ``select`` statement, either all of them or just a page.
+
+        For a page, ``count`` is a statement counting all the rows, ``keyset``
+        is called with the values of the page's ``after`` key to get a
+        condition, and its parameters, for rows following that key, and
+        ``key`` gives a row's key.
+        """
+        def where_sql(conditions: list[str]) -> str:
+            return f' where {" and ".join(conditions)}' if len(conditions) else ''
+        if page is None:
+            return self.__db.execute(f'{select}{where_sql(where)} order by {order}', values).fetchall()   # type: ignore
+        page.total = self.__db.execute(f'{count}{where_sql(where)}', values).fetchone()[0]   # type: ignore
+        if keyset is not None and page.after is not None:
+            (condition, parameters) = keyset(*page.after)
+            where = where + [condition]
+            values = values + parameters
+        rows = self.__db.execute(f'{select}{where_sql(where)} order by {order} limit ?',       # type: ignore
+                                 values + [page.limit + 1]).fetchall()
+        if len(rows) > page.limit and key is not None:
+            rows = rows[:page.limit]
+            page.next = key(rows[-1])
+        return rows
+
+    def annotated_item_ids(self, resource_id: str, page: Optional[Page]=None) -> dict:
+    #=================================================================================
         item_ids = []
         if self.__db is not None:
             item_ids = [row[0]
-                        for row in self.__db.execute('''select distinct itemid
-                                                        from annotations where resource=?
-                                                         order by itemid''', (resource_id, ))
-                                            .fetchall()]
+                        for row in self.__rows('select distinct itemid from annotations',
+                                               'select count(distinct itemid) from annotations',
+                                               ['resource=?'], [resource_id], 'itemid',
+                                               page, lambda *key: ('itemid > ?', self.__key_values(key, str)), lambda row: [row[0]])]
         return {
             'resource': resource_id,
             'itemIds': item_ids
         }
 
-    def user_item_ids(self, resource_id: str, user_id: Optional[str], participated: bool) -> dict:
-    #=============================================================================================
+    def user_item_ids(self, resource_id: str, user_id: Optional[str], participated: bool,
+                      page: Optional[Page]=None) -> dict:
+    #=====================================================================================
         item_ids = []
         if self.__db is not None and user_id is not None:
             # Querying participated annotations if participated True, else non-participated annotations
             item_ids = [row[0]
-                        for row in self.__db.execute(f'''select distinct itemid from annotations
-                                                         where resource=? and orcid {"=" if participated else "!="} ?
-                                                         order by itemid''', (resource_id, user_id))
-                                            .fetchall()]
+                        for row in self.__rows('select distinct itemid from annotations',
+                                               'select count(distinct itemid) from annotations',
+                                               ['resource=?', f'orcid {"=" if participated else "!="} ?'],
+                                               [resource_id, user_id], 'itemid',
+                                               page, lambda *key: ('itemid > ?', self.__key_values(key, str)), lambda row: [row[0]])]
         return {
             'resource': resource_id,
             'itemIds': item_ids,
@@ -162,82 +338,222 @@ class AnnotationStore:
             'participated': participated,
         }
 
-    def features(self, resource_id: str) -> dict:
-    #============================================
+    def features(self, resource_id: str, page: Optional[Page]=None) -> bytes:
+    #========================================================================
         features = []
         if self.__db is not None:
-            features = [json.loads(row[0])
-                           for row in self.__db.execute('''select feature from features
-                                                           where deleted is null and resource=?
-                                                           order by itemid''', (resource_id, ))
-                                                .fetchall()]
-        return {
-            'resource': resource_id,
-            'features': features
-        }
+            features = [row[0] for row in self.__feature_rows(['deleted is null', 'resource=?'],
+                                                              [resource_id], page)]
+        return self.__features_json(resource_id, features)
 
-    def item_features(self, resource_id: str, item_ids: list[str]) -> dict:
-    #======================================================================
+    def item_features(self, resource_id: str, item_ids: list[str], page: Optional[Page]=None) -> bytes:
+    #==================================================================================================
         features = []
         if self.__db is not None and len(item_ids):
-            features = [json.loads(row[0])
-                for row in self.__db.execute(f'''select feature from features
-                                                 where deleted is null and resource=?
-                                                       and itemid in ({", ".join("?"*len(item_ids))})
-                                                 order by itemid''', (resource_id, *item_ids))
-                                    .fetchall()]
-        return {
-            'resource': resource_id,
-            'features': features
-        }
-
-    def annotations(self, resource_id: Optional[str]=None, item_id: Optional[str]=None) -> list[dict]:
-    #=================================================================================================
+            features = [row[0]
+                for row in self.__feature_rows(['deleted is null', 'resource=?',
+                                                f'itemid in ({", ".join("?"*len(item_ids))})'],
+                                               [resource_id, *item_ids], page)]
+        return self.__features_json(resource_id, features)
+
+    @staticmethod
+    def __features_json(resource_id: str, features: list[str]) -> bytes:
+    #===================================================================
+        # Stored features are already JSON
+        return f'{{"features":[{",".join(features)}],"resource":{json.dumps(resource_id)}}}'.encode()
+
+    def __feature_rows(self, where: list[str], values: list, page: Optional[Page]) -> list[tuple]:
+    #============================================================================================
+        return self.__rows('select feature, itemid, rowid from features', 'select count(*) from features',
+                           where, values, 'itemid, rowid',
+                           page, lambda *key: ('(itemid, rowid) > (?, ?)', self.__key_values(key, str, int)),
+                           lambda row: [row[1], row[2]])
+
+    def annotations(self, resource_id: Optional[str]=None, item_id: Optional[str]=None,
+                    page: Optional[Page]=None) -> bytes:
+    #=================================================================================
+        """
+        Annotations as a JSON array.
+        """
+        if page is None:
+            return b''.join(json_items(self.iter_annotations(resource_id, item_id)))
         annotations = []
         if self.__db is not None:
-            where_values = []
-            if resource_id is None:
-                where_statement =  ''
-            else:
-                where_clauses = ['resource=?']
-                where_values.append(resource_id)
-                if item_id is not None:
-                    where_clauses.append('itemid=?')
-                    where_values.append(item_id)
-                where_statement = 'where ' + ' and '.join(where_clauses)
-            for row in self.__db.execute(f'''select rowid, created, creator, annotation, resource, itemid, item
+            (where, values) = self.__annotation_conditions(resource_id, item_id)
+            annotations = [self.__annotation_json(row)
+                for row in self.__rows(f'select {ANNOTATION_COLUMNS} from annotations',
+                                       'select count(*) from annotations', where, values,
+                                       'created desc, creator, rowid', page,
+                                       self.__annotation_keyset, lambda row: [row[1], row[0]])]
+        return b''.join(json_items(annotations))
+
+    def iter_annotations(self, resource_id: Optional[str]=None, item_id: Optional[str]=None) -> Iterator[bytes]:
+    #===========================================================================================================
+        """
+        The JSON of each annotation, as it is read.
+        """
+        if self.__db is not None:
+            (where, values) = self.__annotation_conditions(resource_id, item_id)
+            where_statement = f'where {" and ".join(where)}' if len(where) else ''
+            for row in self.__db.execute(f'''select {ANNOTATION_COLUMNS}
                                         from annotations {where_statement}
-                                        order by created desc, creator''',
-                                    tuple(where_values)).fetchall():
-                annotation = {
-                    'annotationId': int(row[0]),
-                    'resource': row[4],
-                    'item': json.loads(row[6]),
-                    'created': row[1],
-                    'creator': json.loads(row[2])
-                }
-                annotation.update(json.loads(row[3]))
-                annotations.append(annotation)
-        return annotations
+                                        order by created desc, creator, rowid''',
+                                    tuple(values)):
+                yield self.__annotation_json(row)
+
+    @staticmethod
+    def __key_values(key: tuple, *types: type) -> list:
+    #==================================================
+        # The values of a page's ``after`` key, checked against those of the listing's rows
+        if len(key) != len(types) or any(type(value) is not kind for (value, kind) in zip(key, types)):
+            raise PageError('Invalid page cursor')
+        return list(key)
+
+    def __annotation_keyset(self, *key) -> tuple[str, list]:
+    #=======================================================
+        # Annotations are listed newest first, then by creator. A page's key has
+        # just the creation time and rowid, as the creator is personal data, and
+        # the creator is found from the rowid
+        (created, rowid) = self.__key_values(key, str, int)
+        creator = '(select creator from annotations where rowid = ?)'
+        return (f'created <= ? and (created < ? or creator > {creator} or (creator = {creator} and rowid > ?))',
+                [created, created, rowid, rowid, rowid])
+
+    @staticmethod
+    def __annotation(row: tuple) -> dict:
+    #====================================
+        annotation = {
+            'annotationId': int(row[0]),
+            'resource': row[4],
+            'item': json.loads(row[6]),
+            'created': row[1],
+            'creator': json.loads(row[2])
+        }
+        annotation.update(json.loads(row[3]))
+        return annotation
 
-    def annotation(self, annotation_id: int) -> dict:
-    #================================================
-        annotation = {}
+    @staticmethod
+    def __annotation_json(row: tuple, feature: Optional[str]=None) -> bytes:
+    #=======================================================================
+        """
+        The JSON of an annotation, as for :meth:`__annotation`, made by joining
+        the stored JSON of its parts. The stored annotation's own properties
+        come last, so that any with the same name as a part take precedence.
+        """
+        properties = row[3].strip()[1:-1].strip()
+        return (f'{{"annotationId":{int(row[0])},"created":{json.dumps(row[1])},"creator":{row[2]},'
+                + ('' if feature is None else f'"feature":{feature},')
+                + f'"item":{row[6]},"resource":{json.dumps(row[4])}'
+                + (f',{properties}}}' if properties else '}')).encode()
+
+    @staticmethod
+    def __annotation_conditions(resource_id: Optional[str], item_id: Optional[str]) -> tuple[list[str], list]:
+    #=======================================================================================================
+        where_clauses = []
+        where_values = []
+        if resource_id is not None:
+            where_clauses.append('resource=?')
+            where_values.append(resource_id)
+            if item_id is not None:
+                where_clauses.append('itemid=?')
+                where_values.append(item_id)
+        return (where_clauses, where_values)
+
+    def annotation(self, annotation_id: int) -> bytes:
+    #=================================================
+        """
+        An annotation, with any current feature, as JSON.
+        """
         if self.__db is not None:
-            row = self.__db.execute('''select a.resource, a.itemid, a.item, a.created, a.creator, a.annotation, f.feature
-                                        from annotations as a left join features as f on a.rowid = f.annotation
+            row = self.__db.execute('''select a.rowid, a.created, a.creator, a.annotation, a.resource, a.itemid, a.item, f.feature
+                                        from annotations as a left join features as f on cast(f.annotation as integer) = a.rowid
                                         where a.rowid=? and f.deleted is null''', (annotation_id, )).fetchone()
             if row is not None:
-                annotation = {
-                    'annotationId': int(annotation_id),
-                    'resource': row[0],
-                    'item': json.loads(row[2]),
-                    'created': row[3],
-                    'creator': json.loads(row[4]),
-                    'feature': json.loads(row[6]) if row[6] else None,
-                }
-                annotation.update(json.loads(row[5]))
-        return annotation
+                return self.__annotation_json(row, row[7] if row[7] else 'null')
+        return b'{}'
+
+    def changes(self, resource_id: Optional[str], since: int, limit: int) -> dict:
+    #=============================================================================
+        """
+        Annotations, and feature rows, added or replaced by changes after
+        ``since``, in the order of their changes, with at most ``limit``
+        annotations. ``last`` is the number of the last change included, to
+        be used as ``since`` when next asking for changes.
+        """
+        result = {
+            'resource': resource_id,
+            'since': since,
+            'last': since,
+            'annotations': [],
+            'features': []
+        }
+        if self.__db is None:
+            return result
+        # Rows of later changes are ignored, as not all of them may be read
+        last = self.__db.execute('select last from change_sequence').fetchone()[0]
+        (where, values) = self.__annotation_conditions(resource_id, None)
+        where = ' and '.join(where + ['change > ?', 'change <= ?'])
+        rows = self.__db.execute(f'''select {ANNOTATION_COLUMNS}, change from annotations
+                                     where {where} order by change limit ?''',
+                                 (*values, since, last, limit + 1)).fetchall()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1][-1]
+            result['more'] = True
+        result['last'] = max(since, last)
+        result['annotations'] = [dict(self.__annotation(row), change=row[-1]) for row in rows]
+        result['features'] = [{
+            'itemId': row[0],
+            'annotationId': int(row[1]),
+            'deleted': row[2] is not None,
+            'feature': json.loads(row[3]),
+            'change': row[4]
+        } for row in self.__db.execute(f'''select itemid, annotation, deleted, feature, change from features
+                                            where {where} order by change, rowid''',
+                                       (*values, since, last))]
+        return result
+
+    def delete_session(self, session_key: str) -> bool:
+    #==================================================
+        if self.__db is not None:
+            cursor = self.__db.execute('delete from sessions where session=?', (session_key,))
+            self.__db.commit()
+            return cursor.rowcount > 0
+        return False
+
+    def save_session(self, session_key: str, data: dict):
+    #====================================================
+        """
+        Start a session, removing any that have expired.
+        """
+        if self.__db is not None:
+            now = time.time()
+            self.__db.execute('delete from sessions where last_used < ?', (now - SESSION_TTL,))
+            self.__db.execute('replace into sessions (session, data, created, last_used) values (?, ?, ?, ?)',
+                              (session_key, json.dumps(data), now, now))
+            self.__db.commit()
+
+    def session_data(self, session_key: str) -> Optional[dict]:
+    #==========================================================
+        if self.__db is not None:
+            row = self.__db.execute('select data from sessions where session=? and last_used >= ?',
+                                    (session_key, time.time() - SESSION_TTL)).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+        return None
+
+    def touch_session(self, session_key: str) -> bool:
+    #=================================================
+        """
+        Record that a session has been used, unless it has expired.
+        """
+        if self.__db is not None:
+            now = time.time()
+            cursor = self.__db.execute('update sessions set last_used=? where session=? and last_used >= ?',
+                                       (now, session_key, now - SESSION_TTL))
+            self.__db.commit()
+            return cursor.rowcount > 0
+        return False
 
     def add_annotation(self, annotation: dict) -> dict:
     #==================================================
@@ -253,29 +569,36 @@ class AnnotationStore:
                 item = {
                     'id': item
                 }
-            item_id = item['id']
-            if (resource_id and item_id
-            and creator and (orcid := creator.get('orcid'))):
-                creator.pop('canUpdate', None)
+            item_id = item.get('id')
+            orcid = creator.get('orcid') if isinstance(creator, dict) else None
+            if resource_id and item_id and orcid:
+                if not (isinstance(created, str) and isinstance(resource_id, str) and isinstance(orcid, str)
+                    and isinstance(item_id, (str, int)) and not isinstance(item_id, bool)):
+                    result['error'] = 'Invalid annotation'
+                    return result
+                creator.pop('canUpdate', None)              # type: ignore
+                feature = annotation.pop('feature', None)
                 try:
-                    feature = annotation.pop('feature', None)
-                    cursor = self.__db.cursor()
-                    cursor.execute('''insert into annotations
-                        (resource, itemid, item, created, orcid, creator, annotation) values (?, ?, ?, ?, ?, ?, ?)''',
-                        (resource_id, item_id, json.dumps(item), created, orcid, json.dumps(creator), json.dumps(annotation)))
-                    if cursor.lastrowid is not None:
-                        result['annotationId'] = int(cursor.lastrowid)
-                    # Flag as deleted any non-deleted entries for the feature
-                    cursor.execute('''update features set deleted=?
-                        where deleted is null and resource=? and itemid=?''',
-                        (result['annotationId'], resource_id, item_id))
-                    if feature and isinstance(feature, dict):
-                        # Add a new row when we have a new feature
-                        cursor.execute('''insert into features
-                            (resource, itemid, annotation, deleted, feature) values (?, ?, ?, null, ?)''',
-                            (resource_id, item_id, result['annotationId'], json.dumps(feature)))
-                    cursor.execute('commit')
-                except sqlite3.OperationalError as err:
+                    # Everything is rolled back if any part of the change fails
+                    with self.__db:
+                        cursor = self.__db.cursor()
+                        cursor.execute('update change_sequence set last = last + 1')
+                        change = cursor.execute('select last from change_sequence').fetchone()[0]
+                        cursor.execute('''insert into annotations
+                            (resource, itemid, item, created, orcid, creator, annotation, change) values (?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (resource_id, item_id, json.dumps(item), created, orcid, json.dumps(creator), json.dumps(annotation), change))
+                        annotation_id = int(cursor.lastrowid)      # type: ignore
+                        # Flag as deleted any non-deleted entries for the feature
+                        cursor.execute('''update features set deleted=?, change=?
+                            where deleted is null and resource=? and itemid=?''',
+                            (annotation_id, change, resource_id, item_id))
+                        if feature and isinstance(feature, dict):
+                            # Add a new row when we have a new feature
+                            cursor.execute('''insert into features
+                                (resource, itemid, annotation, deleted, feature, change) values (?, ?, ?, null, ?, ?)''',
+                                (resource_id, item_id, annotation_id, json.dumps(feature), change))
+                    result['annotationId'] = annotation_id
+                except sqlite3.Error as err:
                     result['error'] = str(err)
         else:
             result['error'] = 'No annotation database...'
@@ -283,21 +606,128 @@ class AnnotationStore:
 
 #===============================================================================
 
-__sessions: dict[str, dict] = {}
+class AnnotationStores:
+    """
+    Long-lived connections to the annotation store.
+
+    Each executor thread that reads has its own connection, which can only
+    read. All changes are made through a single connection, used only in
+    the ``writer`` executor's thread. The store is in WAL mode so that reads
+    never wait for a write to finish.
+    """
+    def __init__(self):
+        self.__readers = threading.local()
+        self.__writer: Optional[AnnotationStore] = None
+
+    def reader(self) -> AnnotationStore:
+    #===================================
+        """
+        The calling thread's read-only store, opened again if the annotation
+        store has been replaced.
+        """
+        store = getattr(self.__readers, 'store', None)
+        if store is not None and self.__db_inode(store) != self.__readers.inode:
+            store.close()
+            store = None
+        if store is None:
+            store = AnnotationStore(read_only=True)
+            self.__readers.store = store
+            self.__readers.inode = self.__db_inode(store)
+        return store
+
+    def writer(self) -> AnnotationStore:
+    #===================================
+        """
+        The read-write store, created if necessary. It must only be used in
+        the ``writer`` executor's thread.
+        """
+        if self.__writer is None:
+            self.__writer = AnnotationStore()
+        return self.__writer
+
+    @staticmethod
+    def __db_inode(store: AnnotationStore) -> Optional[int]:
+    #=======================================================
+        try:
+            return os.stat(store.db_name).st_ino
+        except OSError:
+            return None
+
+#===============================================================================
+
+annotation_stores = AnnotationStores()
+
+def __annotation_store_read(method, *args):
+    # Run in a ``db`` executor thread as SQLite connections can only be used
+    # in the thread that created them
+    return method(annotation_stores.reader(), *args)
+
+def __annotation_store_write(method, *args):
+    # Only run in the ``writer`` executor's thread
+    return method(annotation_stores.writer(), *args)
+
+def __annotations_json(stopped: threading.Event, ndjson: bool, *args) -> Iterator[bytes]:
+    # Run in a ``stream`` executor thread, with annotations sent as they
+    # are read
+    yield from json_items(itertools.takewhile(lambda _: not stopped.is_set(),
+                                              annotation_stores.reader().iter_annotations(*args)),
+                          ndjson=ndjson)
+
+async def __annotation_listing(resource_id: Optional[str]=None, item_id: Optional[str]=None):
+    # A full listing is streamed, while a page is read and sent at once
+    try:
+        if (page := __get_page()) is None:
+            return __streamed_annotations(resource_id, item_id)
+        annotations = await run_db(__annotation_store_read, AnnotationStore.annotations,
+                                   resource_id, item_id, page)
+    except PageError as error:
+        quart.abort(400, str(error))
+    return __paged_response(annotations, page)
+
+def __streamed_annotations(*args) -> quart.Response:
+    ndjson = (quart.request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+              == NDJSON_MIMETYPE)
+    return quart.Response(stream_in_thread(__annotations_json, ndjson, *args),
+                          mimetype=NDJSON_MIMETYPE if ndjson else 'application/json')
+
+#===============================================================================
+
+# Sessions known to this process, with when they were last known to be in use
+
+__sessions: dict[str, tuple[dict, float]] = {}
 
 def __session_key(key: str) -> str:
     return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
 
-def __new_session(key: str, data: dict) -> str:
+async def __new_session(key: str, data: dict) -> str:
     session_key = __session_key(key)
-    __sessions[session_key] = data
+    now = time.time()
+    for expired in [other for (other, session) in __sessions.items() if session[1] < now - SESSION_TTL]:
+        del __sessions[expired]
+    __sessions[session_key] = (data, now)
+    await run_writer(__annotation_store_write, AnnotationStore.save_session, session_key, data)
     return session_key
 
-def __session_data(session_key: str) -> Optional[dict]:
-    return __sessions.get(session_key)
-
-def __del_session(session_key: str) -> bool:
-    return __sessions.pop(session_key, None) is not None
+async def __session_data(session_key: str) -> Optional[dict]:
+    now = time.time()
+    if (session := __sessions.get(session_key)) is None:
+        # The session may have been started in another server process
+        data = await run_db(__annotation_store_read, AnnotationStore.session_data, session_key)
+        if data is not None:
+            __sessions[session_key] = (data, now)
+        return data
+    elif session[1] < now - SESSION_TOUCH_INTERVAL:
+        # The session may have expired, or been ended in another server process,
+        # since it was last used here
+        if not await run_writer(__annotation_store_write, AnnotationStore.touch_session, session_key):
+            __sessions.pop(session_key, None)
+            return None
+        __sessions[session_key] = (session[0], now)
+    return session[0]
+
+async def __del_session(session_key: str) -> bool:
+    __sessions.pop(session_key, None)
+    return await run_writer(__annotation_store_write, AnnotationStore.delete_session, session_key)
 
 #===============================================================================
 
@@ -314,7 +744,7 @@ def __authenticated(bearer=False):
             if ((key := parameters.get('key')) is not None
               and (session_key := parameters.get('session')) is not None
               and session_key == __session_key(key)
-              and (data := __session_data(session_key)) is not None):
+              and (data := await __session_data(session_key)) is not None):
                 quart.g.update = data.get('canUpdate', False)
                 return await f(*args, **kwargs)
             if bearer and quart.request.method == 'GET' and settings['ANNOTATOR_TOKENS']:
@@ -335,17 +765,50 @@ def __get_parameter(name: str, default: Any=None):
     result = json.loads(value) if value is not None else default
     return result
 
+def __get_page() -> Optional[Page]:
+    try:
+        limit = __get_parameter('limit')
+    except ValueError:
+        raise PageError('Invalid page limit')
+    after = quart.request.args.get('after')
+    if limit is None and after is None:
+        return None
+    if limit is None:
+        limit = ANNOTATION_PAGE_LIMIT
+    elif not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        raise PageError('Invalid page limit')
+    key = None
+    if after is not None:
+        try:
+            key = json.loads(base64.urlsafe_b64decode(after))
+        except ValueError:
+            raise PageError('Invalid page cursor')
+        if not isinstance(key, list):
+            raise PageError('Invalid page cursor')
+    return Page(min(limit, ANNOTATION_PAGE_LIMIT), key)
+
+def __paged_response(result: Any, page: Optional[Page]) -> quart.Response:
+    # A page's total number of rows and any cursor for the next page are sent
+    # as headers, so that the result itself is unchanged
+    response = (quart.Response(result, mimetype='application/json') if isinstance(result, bytes)
+                else quart.jsonify(result))
+    if page is not None:
+        response.headers['X-Total-Count'] = str(page.total)
+        if page.next is not None:
+            response.headers['X-Next-Cursor'] = base64.urlsafe_b64encode(json.dumps(page.next).encode()).decode()
+    return response
+
 #===============================================================================
 
 @annotator_blueprint.route('authenticate', methods=['GET'])
 async def authenticate():
     parameters = quart.request.args
     if (key := parameters.get('key')) is not None:
-        user_data = get_user(key)
+        user_data = await run_network(get_user, key)
     else:
         user_data = {'error': 'forbidden'}
     if 'error' not in user_data:
-        session_key = __new_session(key, user_data)
+        session_key = await __new_session(key, user_data)
         response = await quart.make_response(json.dumps({
             'session': session_key,
             'data': user_data
@@ -370,14 +833,18 @@ async def unauthenticate():
 async def annotated_items():
     resource_id = __get_parameter('resource')
     user_id = __get_parameter('user')
-    annotation_store = AnnotationStore()
-    if user_id is not None:
-        participated = __get_parameter('participated', True)
-        item_ids = annotation_store.user_item_ids(resource_id, user_id, participated)
-    else:
-        item_ids = annotation_store.annotated_item_ids(resource_id)
-    annotation_store.close()
-    return quart.jsonify(item_ids)
+    try:
+        page = __get_page()
+        if user_id is not None:
+            participated = __get_parameter('participated', True)
+            item_ids = await run_db(__annotation_store_read, AnnotationStore.user_item_ids,
+                                    resource_id, user_id, participated, page)
+        else:
+            item_ids = await run_db(__annotation_store_read, AnnotationStore.annotated_item_ids,
+                                    resource_id, page)
+    except PageError as error:
+        quart.abort(400, str(error))
+    return __paged_response(item_ids, page)
 
 #===============================================================================
 
@@ -386,15 +853,19 @@ async def annotated_items():
 async def features():
     resource_id = __get_parameter('resource')
     item_ids = __get_parameter('items')
-    annotation_store = AnnotationStore()
-    if item_ids is not None:
-        if isinstance(item_ids, str):
-            item_ids = [item_ids]
-        features = annotation_store.item_features(resource_id, item_ids)
-    else:
-        features = annotation_store.features(resource_id)
-    annotation_store.close()
-    return quart.jsonify(features)
+    try:
+        page = __get_page()
+        if item_ids is not None:
+            if isinstance(item_ids, str):
+                item_ids = [item_ids]
+            features = await run_db(__annotation_store_read, AnnotationStore.item_features,
+                                    resource_id, item_ids, page)
+        else:
+            features = await run_db(__annotation_store_read, AnnotationStore.features,
+                                    resource_id, page)
+    except PageError as error:
+        quart.abort(400, str(error))
+    return __paged_response(features, page)
 
 #===============================================================================
 
@@ -403,10 +874,7 @@ async def features():
 async def annotations():
     resource_id = __get_parameter('resource')
     item_id = __get_parameter('item')
-    annotation_store = AnnotationStore()
-    annotations = annotation_store.annotations(resource_id, item_id)
-    annotation_store.close()
-    return quart.jsonify(annotations)
+    return await __annotation_listing(resource_id, item_id)
 
 #===============================================================================
 
@@ -415,36 +883,82 @@ async def annotations():
 @__authenticated(True)
 async def annotation(id: Optional[str]=None):
     annotation_id = __get_parameter('annotation') if id is None else id
-    annotation_store = AnnotationStore()
-    annotation = annotation_store.annotation(annotation_id)
-    annotation_store.close()
-    return quart.jsonify(annotation)
+    annotation = await run_db(__annotation_store_read, AnnotationStore.annotation,
+                              annotation_id)
+    return quart.Response(annotation, mimetype='application/json')
 
 #===============================================================================
 
 @annotator_blueprint.route('annotation/', methods=['POST'])
 @__authenticated()
 async def add_annotation():
-    annotation_store = AnnotationStore()
     if quart.request.method == 'POST' and quart.g.update:
         body = await quart.request.get_json()
         annotation = body.get('data', {})
-        result = annotation_store.add_annotation(annotation)
+        result = await run_writer(__annotation_store_write, AnnotationStore.add_annotation,
+                                  annotation)
+        if 'annotationId' in result:
+            async with __annotation_changed:
+                __annotation_changed.notify_all()
     else:
         result = '{"error": "forbidden"}', 403, {'mimetype': 'application/json'}
-    annotation_store.close()
     return quart.jsonify(result)
 
+#===============================================================================
+
+# Notified when this process adds an annotation
+
+__annotation_changed = asyncio.Condition()
+
+@annotator_blueprint.route('changes/', methods=['GET'])
+@__authenticated()
+async def annotation_changes():
+    """
+    Get the annotations and features of a resource that have changed since
+    a given change, optionally waiting for a change if there are none.
+
+    :<json string resource: the resource, all resources if not given
+    :<json integer since: the ``last`` change of a previous response, ``0`` to
+                          get all changes that have numbers
+    :<json number wait: at most how many seconds to wait for a change, up to
+                        ``ANNOTATION_CHANGES_WAIT``
+
+    :>json integer last: the number of the last change in the response
+    :>json boolean more: set if there are further changes
+    :>jsonarr object annotations: added annotations, with their ``change`` number
+    :>jsonarr object features: features that were added or replaced, with their
+                               ``itemId``, ``annotationId``, ``change`` number and
+                               whether they were ``deleted``
+    """
+    try:
+        resource_id = __get_parameter('resource')
+        since = __get_parameter('since', 0)
+        wait = __get_parameter('wait', 0)
+    except ValueError:
+        return quart.jsonify({'error': 'Invalid change parameters'}), 400
+    # ``json.loads()`` accepts ``NaN`` and ``Infinity``, which can't be clamped
+    if (not isinstance(since, int) or isinstance(since, bool) or since < 0
+     or not isinstance(wait, (int, float)) or isinstance(wait, bool) or not math.isfinite(wait)):
+        return quart.jsonify({'error': 'Invalid change parameters'}), 400
+    deadline = time.monotonic() + min(max(wait, 0), ANNOTATION_CHANGES_WAIT)
+    while True:
+        changes = await run_db(__annotation_store_read, AnnotationStore.changes,
+                               resource_id, since, ANNOTATION_PAGE_LIMIT)
+        if len(changes['annotations']) or (remaining := deadline - time.monotonic()) <= 0:
+            return quart.jsonify(changes)
+        try:
+            async with __annotation_changed:
+                await asyncio.wait_for(__annotation_changed.wait(), min(remaining, ANNOTATION_CHANGES_POLL))
+        except asyncio.TimeoutError:
+            pass
+
 #===============================================================================
 #===============================================================================
 
 @annotator_blueprint.route('download/', methods=['GET'])
 @__authenticated(True)
 async def download():
-    annotation_store = AnnotationStore()
-    annotations = annotation_store.annotations()
-    annotation_store.close()
-    return quart.jsonify(annotations)
+    return await __annotation_listing()
 
 #===============================================================================
 #===============================================================================
@@ -0,0 +1,232 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+#===============================================================================
+
+from landez.sources import InvalidFormatError
+
+#===============================================================================
+
+from .knowledge import read_metadata
+from .mbtiles import file_key, TileDatabase
+
+#===============================================================================
+
+# Minimum time, in seconds, between scans of the flatmap directory
+
+CATALOGUE_REFRESH_INTERVAL = float(os.environ.get('CATALOGUE_REFRESH_INTERVAL', '2'))
+
+# Stands for the URL prefix of map URIs in the serialised listing
+
+URL_PREFIX_MARKER = '\0url-prefix\0'
+
+#===============================================================================
+
+def normalise_identifier(id):
+#============================
+    return ':'.join([(s[:-1].lstrip('0') + s[-1])
+                        for s in id.split(':')])
+
+#===============================================================================
+
+def path_key(path: str) -> Optional[tuple[int, int, int]]:
+#=========================================================
+    try:
+        return file_key(path)
+    except OSError:
+        return None
+
+#===============================================================================
+
+class MapCatalogue:
+    """
+    The flatmaps available under a directory.
+
+    Each map's listing entry is only rebuilt when its directory, ``index.json``
+    or ``index.mbtiles`` change, or the map starts or stops being made. The
+    listing is serialised once, in parts between the maps' URL prefixes, and
+    kept until something changes.
+    """
+    def __init__(self, root: str, maker_sentinel: str):
+        self.__root = root
+        self.__maker_sentinel = maker_sentinel
+        self.__map_states: dict[str, tuple] = {}
+        self.__entries: dict[str, Optional[tuple[dict, Optional[str]]]] = {}
+        self.__listing_parts: Optional[list[bytes]] = None
+        self.__last_scan = None
+        self.__lock = threading.Lock()
+
+    def invalidate(self):
+    #====================
+        """
+        Rescan the flatmap directory on our next refresh.
+        """
+        with self.__lock:
+            self.__last_scan = None
+
+    def map_keys(self) -> dict[str, tuple[int, int, int]]:
+    #======================================================
+        """
+        The identifier of each available map's tile database, keyed by the
+        map's directory name.
+        """
+        with self.__lock:
+            return { name: map_state[3] for (name, map_state) in self.__map_states.items()
+                                            if self.__entries.get(name) is not None }
+
+    def listing(self, url_prefix: str) -> bytes:
+    #===========================================
+        """
+        The list of available flatmaps, as JSON, with each map's URI starting
+        with ``url_prefix``.
+        """
+        with self.__lock:
+            if (listing_parts := self.__listing_parts) is None:
+                flatmap_list = []
+                for entry in self.__entries.values():
+                    if entry is not None:
+                        (flatmap, id) = entry
+                        if id is not None:
+                            flatmap = dict(flatmap, uri=f'{URL_PREFIX_MARKER}{id}/')
+                        flatmap_list.append(flatmap)
+                listing = json.dumps(flatmap_list, sort_keys=True, separators=(',', ':')).encode()
+                listing_parts = listing.split(self.__json_string(URL_PREFIX_MARKER))
+                self.__listing_parts = listing_parts
+        return self.__json_string(url_prefix).join(listing_parts)
+
+    @staticmethod
+    def __json_string(text: str) -> bytes:
+    #=====================================
+        # As ``text`` appears inside a serialised JSON string
+        return json.dumps(text)[1:-1].encode()
+
+    def refresh(self) -> list[str]:
+    #==============================
+        """
+        Update the catalogue with any changes to maps, returning a list of
+        errors found in new or changed maps.
+        """
+        errors = []
+        with self.__lock:
+            now = time.monotonic()
+            if self.__last_scan is not None and now < (self.__last_scan + CATALOGUE_REFRESH_INTERVAL):
+                return errors
+            self.__last_scan = now
+            root_path = pathlib.Path(self.__root)
+            flatmap_dirs = [flatmap_dir for flatmap_dir in root_path.iterdir()
+                                if flatmap_dir.is_dir()] if root_path.is_dir() else []
+            map_states = {}
+            entries = {}
+            for flatmap_dir in flatmap_dirs:
+                map_state = self.__map_state(flatmap_dir)
+                map_states[flatmap_dir.name] = map_state
+                if self.__map_states.get(flatmap_dir.name) == map_state:
+                    entries[flatmap_dir.name] = self.__entries.get(flatmap_dir.name)
+                else:
+                    entries[flatmap_dir.name] = self.__map_entry(flatmap_dir, map_state, errors)
+            if map_states != self.__map_states:
+                self.__listing_parts = None
+            self.__map_states = map_states
+            self.__entries = entries
+        return errors
+
+    def __map_state(self, flatmap_dir: pathlib.Path) -> tuple:
+    #=========================================================
+        return (path_key(str(flatmap_dir)),
+                os.path.exists(flatmap_dir / self.__maker_sentinel),
+                path_key(str(flatmap_dir / 'index.json')),
+                path_key(str(flatmap_dir / 'index.mbtiles')))
+
+    def __map_entry(self, flatmap_dir: pathlib.Path, map_state: tuple, errors: list[str]) -> Optional[tuple[dict, Optional[str]]]:
+    #=============================================================================================================================
+        (_, map_making, index_key, mbtiles_key) = map_state
+        if map_making or index_key is None or mbtiles_key is None:
+            return None
+        try:
+            with open(flatmap_dir / 'index.json') as fp:
+                index = json.loads(fp.read())
+            reader = TileDatabase(str(flatmap_dir / 'index.mbtiles'), mbtiles_key)
+        except (OSError, json.JSONDecodeError, InvalidFormatError) as error:
+            errors.append(f'Cannot read flatmap {flatmap_dir}: {error}')
+            return None
+        version = index.get('version', 1.0)
+        if version >= 1.3:
+            try:
+                metadata: dict[str, str] = read_metadata(reader, 'metadata')
+            except IOError as error:
+                errors.append(f'{error}: {flatmap_dir}')
+                return None
+            if (('id' not in metadata or flatmap_dir.name != metadata['id'])
+             and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
+                errors.append(f'Flatmap id mismatch: {flatmap_dir}')
+                return None
+            flatmap = {
+                'id': metadata['id'],
+                'source': metadata['source'],
+                'version': version
+            }
+            if 'uuid' in metadata:
+                flatmap['uuid'] = metadata['uuid']
+                id = metadata['uuid']
+            else:
+                id = metadata['id']
+            if 'created' in metadata:
+                flatmap['created'] = metadata['created']
+            if 'taxon' in metadata:
+                flatmap['taxon'] = normalise_identifier(metadata['taxon'])
+                flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
+            elif 'describes' in metadata:
+                flatmap['taxon'] = normalise_identifier(metadata['describes'])
+                flatmap['describes'] = flatmap['taxon']
+            if 'biological-sex' in metadata:
+                flatmap['biologicalSex'] = metadata['biological-sex']
+            if 'name' in metadata:
+                flatmap['name'] = metadata['name']
+        else:
+            source_row = None
+            try:
+                source_row = reader._query("SELECT value FROM metadata WHERE name='source'").fetchone()
+            except (InvalidFormatError, sqlite3.OperationalError):
+                errors.append(f'Cannot read tile database: {flatmap_dir}')
+                return None
+            if source_row is None:
+                return None
+            flatmap = {
+                'id': flatmap_dir.name,
+                'source': source_row[0]
+            }
+            id = None
+            created = reader._query("SELECT value FROM metadata WHERE name='created'").fetchone()
+            if created is not None:
+                flatmap['created'] = created[0]
+            describes = reader._query("SELECT value FROM metadata WHERE name='describes'").fetchone()
+            if describes is not None and describes[0]:
+                flatmap['describes'] = normalise_identifier(describes[0])
+        return (flatmap, id)
+
+#===============================================================================
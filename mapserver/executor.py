@@ -0,0 +1,163 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+from typing import Any, Callable
+
+#===============================================================================
+
+# Number of threads for each kind of blocking work
+
+DB_THREADS = int(os.environ.get('DB_THREADS', '8'))
+CPU_THREADS = int(os.environ.get('CPU_THREADS', str(min(4, os.cpu_count() or 1))))
+NETWORK_THREADS = int(os.environ.get('NETWORK_THREADS', '16'))
+STREAM_THREADS = int(os.environ.get('STREAM_THREADS', '16'))
+
+#===============================================================================
+
+class Executor:
+    """
+    A bounded pool of threads for blocking work, so that the work doesn't
+    stall the event loop, with counts of queued and running jobs.
+    """
+    def __init__(self, name: str, max_workers: int):
+        self.__name = name
+        self.__max_workers = max(1, max_workers)
+        self.__pool = ThreadPoolExecutor(self.__max_workers, thread_name_prefix=f'{name}-executor')
+        self.__queued = 0
+        self.__max_queued = 0
+        self.__running = 0
+        self.__completed = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'workers': self.__max_workers,
+                'queued': self.__queued,
+                'maxQueued': self.__max_queued,
+                'running': self.__running,
+                'completed': self.__completed
+            }
+
+    async def run(self, func: Callable, *args, **kwds) -> Any:
+    #=========================================================
+        """
+        Run a function in one of our threads and wait for its result.
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, **kwds))
+
+    def submit(self, func: Callable, *args, **kwds) -> Future:
+    #=========================================================
+        """
+        Queue a function to run in one of our threads.
+        """
+        with self.__lock:
+            self.__queued += 1
+            if self.__queued > self.__max_queued:
+                self.__max_queued = self.__queued
+        future = self.__pool.submit(self.__run, func, *args, **kwds)
+        future.add_done_callback(self.__done)
+        return future
+
+    def shutdown(self):
+    #==================
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+
+    def __done(self, future: Future):
+    #================================
+        # A job cancelled before it started is no longer queued
+        if future.cancelled():
+            with self.__lock:
+                self.__queued -= 1
+
+    def __run(self, func: Callable, *args, **kwds) -> Any:
+    #=====================================================
+        with self.__lock:
+            self.__queued -= 1
+            self.__running += 1
+        try:
+            return func(*args, **kwds)
+        finally:
+            with self.__lock:
+                self.__running -= 1
+                self.__completed += 1
+
+#===============================================================================
+
+# SQLite and file access
+
+db_executor = Executor('db', DB_THREADS)
+
+# Decoding, encoding and graph building
+
+cpu_executor = Executor('cpu', CPU_THREADS)
+
+# Requests to other services
+
+network_executor = Executor('network', NETWORK_THREADS)
+
+# Reading results that are sent to clients as they are read, so that slow
+# clients don't hold up other database access
+
+stream_executor = Executor('stream', STREAM_THREADS)
+
+# Changes to a database, made one at a time
+
+writer_executor = Executor('writer', 1)
+
+# Work that nobody is waiting for, such as precomputing derived resources,
+# done one job at a time
+
+background_executor = Executor('background', 1)
+
+#===============================================================================
+
+async def run_db(func: Callable, *args, **kwds) -> Any:
+#======================================================
+    return await db_executor.run(func, *args, **kwds)
+
+async def run_cpu(func: Callable, *args, **kwds) -> Any:
+#=======================================================
+    return await cpu_executor.run(func, *args, **kwds)
+
+async def run_network(func: Callable, *args, **kwds) -> Any:
+#===========================================================
+    return await network_executor.run(func, *args, **kwds)
+
+async def run_writer(func: Callable, *args, **kwds) -> Any:
+#==========================================================
+    return await writer_executor.run(func, *args, **kwds)
+
+def executor_stats() -> dict:
+#============================
+    return { executor.name: executor.stats
+                for executor in [db_executor, cpu_executor, network_executor,
+                                 stream_executor, writer_executor, background_executor] }
+
+#===============================================================================
@@ -18,10 +18,16 @@
 #
 #===============================================================================
 
+from collections import OrderedDict
+import hashlib
 import os
 import json
+import re
 import sqlite3
 import sys
+import threading
+import time
+from typing import Callable, Hashable, Iterable, Iterator, Optional
 
 #===============================================================================
 
@@ -30,22 +36,199 @@ from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
 
 #===============================================================================
 
+from ..mbtiles import tile_databases
 from ..settings import settings
+from ..singleflight import SingleFlight
 
 #===============================================================================
 
-def read_metadata(tile_reader: MBTilesReader, name: str):
+# The memory budget, in bytes, for map metadata
+
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', str(128*1024*1024)))
+
+# Decoded metadata takes several times the memory of its JSON
+
+DECODED_SIZE_FACTOR = 4
+
+# How many SQLite virtual machine instructions to run between checks
+# for an interrupted query
+
+QUERY_PROGRESS_STEPS = 10000
+
+# Query rows are read from SQLite in batches of this size
+
+QUERY_BATCH_SIZE = 1000
+
+# Entities whose labels are read from the knowledge base with one statement
+
+LABEL_QUERY_BATCH = 500
+
+# How many entity labels are kept in memory
+
+LABEL_CACHE_SIZE = int(os.environ.get('LABEL_CACHE_SIZE', '100000'))
+
+# How long, in seconds, an entity is remembered as not having a label
+
+LABEL_NEGATIVE_TTL = float(os.environ.get('LABEL_NEGATIVE_TTL', '3600'))
+
+# The memory budget, in bytes, for the results of knowledge queries; with
+# ``0`` meaning that results are not cached
+
+QUERY_RESULT_CACHE_SIZE = int(os.environ.get('QUERY_RESULT_CACHE_SIZE', str(32*1024*1024)))
+
+# A result that is larger than this fraction of the budget isn't cached
+
+QUERY_RESULT_MAX_FRACTION = 8
+
+# How many different query fingerprints have their statistics kept
+
+QUERY_STATISTICS_SIZE = 256
+
+#===============================================================================
+
+def read_metadata_json(tile_reader: MBTilesReader, name: str) -> str:
     row = None
     try:
-        if (query_result:=tile_reader._query("SELECT value FROM metadata WHERE name='{}'".format(name))) is not None:
+        if (query_result:=tile_reader._query('SELECT value FROM metadata WHERE name=?', (name,))) is not None:
             row = query_result.fetchone()
     except (InvalidFormatError, sqlite3.OperationalError):
         raise IOError('Cannot read tile database')
-    return {} if row is None else json.loads(row[0])
+    return '{}' if row is None else row[0]
+
+def read_metadata(tile_reader: MBTilesReader, name: str):
+    return json.loads(read_metadata_json(tile_reader, name))
+
+#===============================================================================
+
+class MetadataEntry:
+    def __init__(self, key: tuple[int, int, int], json_text: str):
+        self.__key = key
+        self.__json = json_text.encode()
+        self.__value = None
+        self.__decoded = False
+
+    @property
+    def decoded(self) -> bool:
+        return self.__decoded
+
+    @property
+    def json(self) -> bytes:
+        return self.__json
+
+    @property
+    def key(self) -> tuple[int, int, int]:
+        return self.__key
+
+    @property
+    def value(self):
+        if not self.__decoded:
+            self.__value = json.loads(self.__json)
+            self.__decoded = True
+        return self.__value
+
+#===============================================================================
+
+class MetadataCache:
+    """
+    Recently used map metadata, as both its JSON and, once asked for, its
+    decoded value, kept within a memory budget. All of a map's metadata is
+    dropped when its tile database is seen to have changed.
+
+    Decoded values are shared and so must not be modified.
+    """
+    def __init__(self, max_bytes: int=METADATA_CACHE_SIZE):
+        self.__max_bytes = max_bytes
+        self.__entries: OrderedDict[tuple[str, str], MetadataEntry] = OrderedDict()
+        self.__entry_sizes: dict[tuple[str, str], int] = {}
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+        # Concurrent reads and decodes of the same metadata are shared
+        self.__loads = SingleFlight()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'shared': self.__loads.stats['shared'],
+                'entries': len(self.__entries),
+                'bytes': self.__size,
+                'budget': self.__max_bytes
+            }
+
+    def get(self, map_id: str, name: str):
+    #=====================================
+        entry = self.__entry(map_id, name)
+        if entry.decoded:
+            return entry.value
+        value = self.__loads.call((map_id, name, entry.key, 'value'), lambda: entry.value)
+        self.__resized((map_id, name), entry)
+        return value
+
+    def json(self, map_id: str, name: str) -> bytes:
+    #===============================================
+        return self.__entry(map_id, name).json
+
+    def __entry(self, map_id: str, name: str) -> MetadataEntry:
+    #==========================================================
+        mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, 'index.mbtiles')
+        try:
+            tile_reader = tile_databases.get(mbtiles)
+        except InvalidFormatError:
+            raise IOError('Cannot read tile database')
+        key = (map_id, name)
+        with self.__lock:
+            if (entry := self.__entries.get(key)) is not None:
+                if entry.key == tile_reader.key:
+                    self.__hits += 1
+                    self.__entries.move_to_end(key)
+                    return entry
+                self.__invalidate(map_id)
+            self.__misses += 1
+        entry = self.__loads.call((map_id, name, tile_reader.key, 'json'),
+                                  lambda: MetadataEntry(tile_reader.key, read_metadata_json(tile_reader, name)))
+        if self.__max_bytes > 0:
+            with self.__lock:
+                if key not in self.__entries:
+                    self.__entries[key] = entry
+                    self.__entry_sizes[key] = len(entry.json)
+                    self.__size += len(entry.json)
+                    self.__evict()
+        return entry
+
+    def __evict(self):
+    #=================
+        while self.__size > self.__max_bytes and len(self.__entries):
+            (key, _) = self.__entries.popitem(last=False)
+            self.__size -= self.__entry_sizes.pop(key)
+
+    def __invalidate(self, map_id: str):
+    #===================================
+        for key in [key for key in self.__entries if key[0] == map_id]:
+            del self.__entries[key]
+            self.__size -= self.__entry_sizes.pop(key)
+
+    def __resized(self, key: tuple[str, str], entry: MetadataEntry):
+    #===============================================================
+        # Account for the memory used by a newly decoded value
+        with self.__lock:
+            if self.__entries.get(key) is entry and self.__entry_sizes[key] == len(entry.json):
+                self.__entry_sizes[key] += DECODED_SIZE_FACTOR*len(entry.json)
+                self.__size += DECODED_SIZE_FACTOR*len(entry.json)
+                self.__evict()
+
+#===============================================================================
+
+metadata_cache = MetadataCache()
 
 def get_metadata(map_id: str, name: str):
-    mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, 'index.mbtiles')
-    return read_metadata(MBTilesReader(mbtiles), name)
+    return metadata_cache.get(map_id, name)
+
+def get_metadata_json(map_id: str, name: str) -> bytes:
+    return metadata_cache.json(map_id, name)
 
 #===============================================================================
 
@@ -61,18 +244,478 @@ class KnowledgeStore(flatmapknowledge.KnowledgeStore):
     def error(self):
         return self.__error
 
-    def query(self, sql, params):
+    def query_rows(self, sql, params, max_rows: Optional[int]=None, skip_rows: int=0,
+                   interrupt: Optional[Callable[[], bool]]=None) -> 'QueryRows':
+    #============================================================================
+        """
+        Run a query, with its rows read as they are iterated over. At most
+        ``max_rows`` rows are read after skipping the first ``skip_rows``,
+        and ``more`` is set if there are further rows. The query is abandoned,
+        with an ``interrupted`` error, as soon as ``interrupt()`` returns
+        ``True``.
+        """
+        return QueryRows(None if self.__error is not None else self.db, sql, params,  # type: ignore
+                         max_rows, skip_rows, interrupt, self.__error)
+
+    def stored_label(self, entity: str) -> Optional[str]:
+    #====================================================
+        """
+        An entity's label if it is in the knowledge base, without looking
+        it up elsewhere.
+        """
+        if self.__error is not None:
+            return None
+        try:
+            row = self.db.execute('SELECT label FROM labels WHERE entity=?', (entity,)).fetchone()  # type: ignore
+        except (sqlite3.DatabaseError, sqlite3.OperationalError):
+            return None
+        return None if row is None else row[0]
+
+    def stored_labels(self, entities: list[str]) -> dict[str, str]:
+    #==============================================================
+        """
+        The labels of those entities that are in the knowledge base, without
+        looking up any others.
+        """
+        labels = {}
+        if self.__error is not None:
+            return labels
+        try:
+            for start in range(0, len(entities), LABEL_QUERY_BATCH):
+                batch = entities[start:start+LABEL_QUERY_BATCH]
+                labels.update(self.db.execute(f'SELECT entity, label FROM labels WHERE entity IN ({", ".join(len(batch)*"?")})',  # type: ignore
+                                              tuple(batch)).fetchall())
+        except (sqlite3.DatabaseError, sqlite3.OperationalError):
+            pass
+        return labels
+
+    def stored_label_items(self, max_items: int) -> Iterator[tuple[str, str]]:
+    #=========================================================================
+        """
+        Entities and their labels from the knowledge base.
+        """
         if self.__error is not None:
-            return { 'error': self.__error }
+            return
+        try:
+            yield from self.db.execute('SELECT entity, label FROM labels LIMIT ?', (max_items,))  # type: ignore
+        except (sqlite3.DatabaseError, sqlite3.OperationalError):
+            pass
+
+    def save_labels(self, labels: dict[str, str]):
+    #=============================================
+        """
+        Save entity labels in the knowledge base, in a single transaction.
+        """
+        if self.__error is not None or len(labels) == 0:
+            return
         try:
-            cursor = self.db.execute(sql, params)  # type: ignore
-            result = {
-                'keys': tuple(d[0] for d in cursor.description),
-                'values': cursor.fetchall()
+            with self.db:       # type: ignore
+                self.db.executemany('REPLACE INTO labels (entity, label) VALUES (?, ?)', labels.items())  # type: ignore
+        except (sqlite3.DatabaseError, sqlite3.OperationalError):
+            pass
+
+#===============================================================================
+
+class QueryRows:
+    """
+    The rows of a query, read from the database as they are iterated over,
+    which must be in the thread that made the query.
+
+    :attr:`more` and :attr:`error` are only known once iteration has finished.
+    """
+    def __init__(self, db: Optional[sqlite3.Connection], sql, params, max_rows: Optional[int],
+                 skip_rows: int, interrupt: Optional[Callable[[], bool]], error: Optional[str]=None):
+        self.__db = db
+        self.__cursor = None
+        self.__keys = ()
+        self.__max_rows = max_rows
+        self.__more = False
+        self.__error = error
+        self.__interrupt = interrupt
+        if db is None:
+            return
+        if interrupt is not None:
+            db.set_progress_handler(interrupt, QUERY_PROGRESS_STEPS)
+        try:
+            self.__cursor = db.execute(sql, params)
+            if self.__cursor.description is None:
+                self.__error = 'Query does not return rows'
+                self.__close()
+                return
+            while skip_rows > 0 and len(rows := self.__cursor.fetchmany(min(skip_rows, QUERY_BATCH_SIZE))):
+                skip_rows -= len(rows)
+            self.__keys = tuple(d[0] for d in self.__cursor.description)
+        except sqlite3.Error as error:
+            self.__error = str(error)
+            self.__close()
+
+    @property
+    def error(self) -> Optional[str]:
+        return self.__error
+
+    @property
+    def keys(self) -> tuple[str, ...]:
+        return self.__keys
+
+    @property
+    def more(self) -> bool:
+        return self.__more
+
+    def __iter__(self) -> Iterator[tuple]:
+        if self.__cursor is None:
+            return
+        try:
+            count = 0
+            while self.__max_rows is None or count < self.__max_rows:
+                batch_size = (QUERY_BATCH_SIZE if self.__max_rows is None
+                              else min(QUERY_BATCH_SIZE, self.__max_rows - count))
+                if len(rows := self.__cursor.fetchmany(batch_size)) == 0:
+                    break
+                count += len(rows)
+                yield from rows
+            else:
+                self.__more = self.__cursor.fetchone() is not None
+        except sqlite3.Error as error:
+            self.__error = str(error)
+        finally:
+            self.__close()
+
+    def __close(self):
+    #=================
+        if self.__cursor is not None:
+            self.__cursor.close()
+            self.__cursor = None
+        if self.__db is not None:
+            if self.__interrupt is not None:
+                self.__db.set_progress_handler(None, 0)
+            # A query may have started a transaction, which would keep the
+            # long-lived connection reading an old snapshot
+            if self.__db.in_transaction:
+                try:
+                    self.__db.rollback()
+                except sqlite3.Error:
+                    pass
+        self.__db = None
+
+#===============================================================================
+
+class KnowledgeStores:
+    """
+    Long-lived connections to the server's knowledge base.
+
+    Each executor thread that reads has its own read-only store. All
+    changes are made through a single read-write store, used only in the
+    ``writer`` executor's thread. The knowledge base is put into WAL mode so
+    that reads never wait for a write to finish.
+    """
+    def __init__(self):
+        self.__readers = threading.local()
+        self.__writer: Optional[KnowledgeStore] = None
+
+    def reader(self) -> KnowledgeStore:
+    #==================================
+        """
+        The calling thread's read-only store, opened again if the knowledge
+        base has been replaced.
+        """
+        store = getattr(self.__readers, 'store', None)
+        if store is not None and (store.error is not None
+                               or self.__db_inode(store) != self.__readers.inode):
+            if store.error is None:
+                store.close()
+            store = None
+        if store is None:
+            store = KnowledgeStore(settings['FLATMAP_ROOT'], create=False, read_only=True)
+            self.__readers.store = store
+            self.__readers.inode = self.__db_inode(store)
+        return store
+
+    def writer(self) -> KnowledgeStore:
+    #==================================
+        """
+        The read-write store, created if necessary. It must only be used in
+        the ``writer`` executor's thread.
+        """
+        if self.__writer is None:
+            self.__writer = KnowledgeStore(settings['FLATMAP_ROOT'], create=True, read_only=False)
+            if self.__writer.error is None:
+                self.__writer.db.execute('PRAGMA journal_mode=WAL')   # type: ignore
+        return self.__writer
+
+    def data_version(self) -> tuple:
+    #===============================
+        """
+        A value that changes whenever the knowledge base is written to or
+        replaced, including writes still in its write-ahead log.
+        """
+        db_name = self.reader().db_name
+        return (self.__file_version(db_name), self.__file_version(f'{db_name}-wal'))
+
+    @staticmethod
+    def __file_version(path: str) -> Optional[tuple[int, int, int]]:
+    #===============================================================
+        try:
+            stat = os.stat(path)
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def __db_inode(store: KnowledgeStore) -> Optional[int]:
+    #======================================================
+        try:
+            return os.stat(store.db_name).st_ino
+        except OSError:
+            return None
+
+#===============================================================================
+
+knowledge_stores = KnowledgeStores()
+
+#===============================================================================
+
+# Parts of SQL that are ignored when fingerprinting
+
+SQL_LEXEMES = re.compile(r"""(?P<string>'(?:[^']|'')*'|x'[0-9a-f]*')
+                            |(?P<identifier>"(?:[^"]|"")*")
+                            |(?P<comment>--[^\n]*|/\*.*?\*/)
+                            |(?P<number>\b\d+(?:\.\d*)?(?:e[-+]?\d+)?\b)
+                            """, re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+SQL_PARAMETER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+SQL_VOLATILE = re.compile(r"\b(?:random|randomblob|changes|total_changes|last_insert_rowid)\s*\(|'now'",
+                          re.IGNORECASE)
+
+def sql_fingerprint(sql: str) -> str:
+#====================================
+    """
+    SQL with its literal values, and any lists of them, replaced by ``?`` and
+    with comments and extra whitespace removed, so that statements differing
+    only in their values have the same fingerprint.
+    """
+    def normalise(match: re.Match) -> str:
+        if match.lastgroup in ['string', 'number']:
+            return '?'
+        elif match.lastgroup == 'comment':
+            return ' '
+        return match.group()
+    return SQL_PARAMETER_LIST.sub('?', ' '.join(SQL_LEXEMES.sub(normalise, sql).split()))
+
+def cacheable_query(sql: str) -> bool:
+#=====================================
+    """
+    Whether a query only reads the knowledge base and always has the same
+    result while the knowledge base is unchanged.
+    """
+    words = sql.split(None, 1)
+    return (len(words) > 0 and words[0].lower() in ['select', 'with']
+        and SQL_VOLATILE.search(sql) is None)
+
+#===============================================================================
+
+class LabelCache:
+    """
+    Recently used entity labels, with the least recently used dropped once
+    there are more than ``max_entries``.
+
+    An entity without a label, i.e. one whose label is the entity itself, is
+    remembered as such for ``negative_ttl`` seconds so that it isn't looked
+    up again and again.
+    """
+    def __init__(self, max_entries: int=LABEL_CACHE_SIZE, negative_ttl: float=LABEL_NEGATIVE_TTL):
+        self.__max_entries = max_entries
+        self.__negative_ttl = negative_ttl
+        # Each entity's label and, for an entity without one, when that expires
+        self.__labels: OrderedDict[str, tuple[str, Optional[float]]] = OrderedDict()
+        self.__hits = 0
+        self.__negative_hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'negativeHits': self.__negative_hits,
+                'misses': self.__misses,
+                'entries': len(self.__labels),
+                'maxEntries': self.__max_entries
             }
-            cursor.close()
-            return result
-        except (sqlite3.DatabaseError, sqlite3.ProgrammingError, sqlite3.OperationalError) as error:
-            return { 'error': str(error) }
+
+    def get(self, entity: str) -> Optional[str]:
+    #===========================================
+        """
+        An entity's label, if we know it.
+        """
+        with self.__lock:
+            if (entry := self.__labels.get(entity)) is not None:
+                (label, expires) = entry
+                if expires is None or expires > time.monotonic():
+                    self.__labels.move_to_end(entity)
+                    if expires is None:
+                        self.__hits += 1
+                    else:
+                        self.__negative_hits += 1
+                    return label
+                del self.__labels[entity]
+            self.__misses += 1
+            return None
+
+    def put(self, entity: str, label: str):
+    #======================================
+        negative = not label or label == entity
+        if self.__max_entries <= 0 or negative and self.__negative_ttl <= 0:
+            return
+        with self.__lock:
+            self.__labels[entity] = (entity, time.monotonic() + self.__negative_ttl) if negative else (label, None)
+            self.__labels.move_to_end(entity)
+            while len(self.__labels) > self.__max_entries:
+                self.__labels.popitem(last=False)
+
+    def warm(self, labels: Iterable[tuple[str, str]]) -> int:
+    #========================================================
+        """
+        Add labels for entities we don't already have, while there is room
+        without dropping any. Returns the number of labels added.
+        """
+        count = 0
+        for (entity, label) in labels:
+            if not label or label == entity:
+                continue
+            with self.__lock:
+                if len(self.__labels) >= self.__max_entries:
+                    break
+                if entity not in self.__labels:
+                    self.__labels[entity] = (label, None)
+                    self.__labels.move_to_end(entity, last=False)
+                    count += 1
+        return count
+
+#===============================================================================
+
+class QueryResultCache:
+    """
+    The encoded results of recent knowledge queries, kept within a memory
+    budget. Everything is dropped when the knowledge base changes.
+    """
+    def __init__(self, max_bytes: int=QUERY_RESULT_CACHE_SIZE):
+        self.__max_bytes = max_bytes
+        self.__entries: OrderedDict[Hashable, tuple[bytes, int]] = OrderedDict()
+        self.__size = 0
+        self.__data_version = None
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def max_entry_size(self) -> int:
+        return self.__max_bytes//QUERY_RESULT_MAX_FRACTION
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'entries': len(self.__entries),
+                'bytes': self.__size,
+                'budget': self.__max_bytes
+            }
+
+    def get(self, key: Hashable, data_version: tuple) -> Optional[tuple[bytes, int]]:
+    #================================================================================
+        """
+        A query's result and its number of rows, if we have it.
+        """
+        with self.__lock:
+            self.__check_version(data_version)
+            if (entry := self.__entries.get(key)) is not None:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+            else:
+                self.__misses += 1
+            return entry
+
+    def put(self, key: Hashable, data_version: tuple, result: bytes, rows: int):
+    #===========================================================================
+        if len(result) > self.max_entry_size:
+            return
+        with self.__lock:
+            self.__check_version(data_version)
+            if data_version != self.__data_version or key in self.__entries:
+                return
+            self.__entries[key] = (result, rows)
+            self.__size += len(result)
+            while self.__size > self.__max_bytes:
+                (_, (evicted, _)) = self.__entries.popitem(last=False)
+                self.__size -= len(evicted)
+
+    def __check_version(self, data_version: tuple):
+    #==============================================
+        if data_version != self.__data_version:
+            self.__entries.clear()
+            self.__size = 0
+            self.__data_version = data_version
+
+#===============================================================================
+
+class QueryStatistics:
+    """
+    Call counts and timings of knowledge queries, by fingerprint. Queries
+    seen after we have :data:`QUERY_STATISTICS_SIZE` fingerprints are counted
+    together.
+    """
+    def __init__(self, max_fingerprints: int=QUERY_STATISTICS_SIZE):
+        self.__max_fingerprints = max_fingerprints
+        self.__queries: dict[str, dict] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self) -> list[dict]:
+        """
+        Statistics of each fingerprint, those taking the most total time
+        first.
+        """
+        with self.__lock:
+            queries = [dict(query) for query in self.__queries.values()]
+        for query in queries:
+            query['meanTime'] = query['totalTime']/query['calls']
+        return sorted(queries, key=lambda query: query['totalTime'], reverse=True)
+
+    def record(self, fingerprint: str, seconds: float, rows: int, cached: bool=False, error: bool=False):
+    #===================================================================================================
+        with self.__lock:
+            if (query := self.__queries.get(fingerprint)) is None:
+                if len(self.__queries) >= self.__max_fingerprints:
+                    fingerprint = '...'
+                    query = self.__queries.get(fingerprint)
+                if query is None:
+                    query = {
+                        'id': hashlib.sha256(fingerprint.encode()).hexdigest()[:16],
+                        'sql': fingerprint[:500],
+                        'calls': 0,
+                        'cached': 0,
+                        'errors': 0,
+                        'rows': 0,
+                        'totalTime': 0.0,
+                        'maxTime': 0.0
+                    }
+                    self.__queries[fingerprint] = query
+            query['calls'] += 1
+            query['cached'] += int(cached)
+            query['errors'] += int(error)
+            query['rows'] += rows
+            query['totalTime'] += seconds
+            query['maxTime'] = max(query['maxTime'], seconds)
+
+#===============================================================================
+
+label_cache = LabelCache()
+
+query_result_cache = QueryResultCache()
+
+query_statistics = QueryStatistics()
 
 #===============================================================================
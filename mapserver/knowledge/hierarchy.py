@@ -18,12 +18,19 @@
 #
 #===============================================================================
 
+from array import array
+import bisect
+from collections import deque
 import functools
 import importlib.resources
-import itertools
 import json
+import math
+import mmap
 import os
-from typing import cast, Optional
+import struct
+import threading
+import time
+from typing import cast, Iterator, Optional
 
 #===============================================================================
 
@@ -33,6 +40,7 @@ import rdflib
 #===============================================================================
 
 from ..settings import settings
+from ..singleflight import SingleFlight
 
 from . import get_metadata
 from .rdf_utils import ILX_BASE, Node, Triple, Uri
@@ -46,10 +54,21 @@ TREE_VERSION = '1.1'
 # Cached hierarchies within FLATMAP_ROOT
 
 CACHED_MAP_HIERARCHY = 'hierarchy.json'
+CACHED_SPARC_GRAPH = 'sparc-hierarchy.bin'
+
+# Previously the SPARC hierarchy was cached as node-link JSON
+
 CACHED_SPARC_HIERARCHY = 'sparc-hierarchy.json'
 
 #===============================================================================
 
+SPARC_GRAPH_MAGIC = b'SPARCGR1'
+SPARC_GRAPH_HEADER = struct.Struct('=8s7I')
+
+BYTE_ORDER_MARK = 0x01020304
+
+#===============================================================================
+
 ONTOLOGY_RESOURCE = importlib.resources.files() / 'ontologies'
 
 NPO_ONTOLOGY = str(ONTOLOGY_RESOURCE / 'npo.ttl')
@@ -71,6 +90,23 @@ PART_OF = Uri('BFO:0000050')
 
 #===============================================================================
 
+def save_json(data, filename: str):
+#==================================
+    """
+    Save JSON so that other processes never see a partially written file.
+    """
+    temp_file = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+    with open(temp_file, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(temp_file, filename)
+
+#===============================================================================
+
+class HierarchyNotReady(Exception):
+    pass
+
+#===============================================================================
+
 class Arborescence:
     def __init__(self, G: nx.DiGraph, root: Uri, contract_to: Optional[Uri]=None):
         assert(root in G)
@@ -227,39 +263,258 @@ class UberonGraph(nx.DiGraph):
 
 #===============================================================================
 
+class SparcGraph:
+    """
+    A read-only SPARC hierarchy, memory-mapped from a compact binary file so
+    that it loads quickly and is shared by all server processes.
+
+    Nodes are numbered, with out-edges held as CSR adjacency arrays and with
+    node labels kept in an interned string table. The shortest distance from
+    each node to every node reachable from it, i.e. to each of its ancestors,
+    is also stored, as sorted arrays of node numbers and distances, so that
+    finding the distance between two terms is a binary search rather than a
+    search of the graph.
+
+    The file starts with a header of a magic string, a byte order mark and the
+    number of nodes, labels, edges and ancestors, and the sizes of the encoded
+    ids and labels. This is followed by arrays of:
+
+    *   node id offsets (``nodes + 1``),
+    *   node label numbers (``nodes``),
+    *   label offsets (``labels + 1``),
+    *   edge offsets (``nodes + 1``) and target nodes (``edges``),
+    *   ancestor offsets (``nodes + 1``), ancestors (``ancestors``) and
+        their distances (``ancestors``, ``uint16``, padded to 32 bits),
+    *   UTF-8 encoded node ids and labels.
+
+    All numbers are ``uint32`` unless noted otherwise.
+    """
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as fp:
+            self.__mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self.__mmap)
+        if len(data) < SPARC_GRAPH_HEADER.size:
+            raise ValueError(f'{filename} is not a SPARC graph')
+        (magic, byte_order, node_count, label_count, edge_count, ancestor_count,
+         id_size, label_size) = SPARC_GRAPH_HEADER.unpack_from(data)
+        if magic != SPARC_GRAPH_MAGIC or byte_order != BYTE_ORDER_MARK:
+            raise ValueError(f'{filename} is not a SPARC graph')
+        position = SPARC_GRAPH_HEADER.size
+        def section(count: int, typecode: str='I') -> memoryview:
+            nonlocal position
+            size = 4*((count*struct.calcsize(typecode) + 3)//4)
+            if position + size > len(data):
+                raise ValueError(f'{filename} is truncated')
+            view = data[position:position + size]
+            position += size
+            return view.cast(typecode)[:count] if typecode != 'B' else view[:count]
+        self.__id_offsets = section(node_count + 1)
+        self.__node_labels = section(node_count)
+        self.__label_offsets = section(label_count + 1)
+        self.__edge_offsets = section(node_count + 1)
+        self.__edge_targets = section(edge_count)
+        self.__ancestor_offsets = section(node_count + 1)
+        self.__ancestors = section(ancestor_count)
+        self.__distances = section(ancestor_count, 'H')
+        self.__id_bytes = section(id_size, 'B')
+        self.__label_bytes = section(label_size, 'B')
+        self.__node_numbers = {self.node_id(node): node for node in range(node_count)}
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self.__node_numbers
+
+    def __len__(self) -> int:
+        return len(self.__node_numbers)
+
+    def ancestors(self, node_id: str) -> Iterator[tuple[str, int]]:
+    #==============================================================
+        """
+        A node's ancestors and their distance from it.
+        """
+        if (node := self.__node_numbers.get(node_id)) is not None:
+            for n in range(self.__ancestor_offsets[node], self.__ancestor_offsets[node+1]):
+                yield (self.node_id(self.__ancestors[n]), self.__distances[n])
+
+    def distance(self, source_id: str, target_id: str) -> int:
+    #=========================================================
+        """
+        The shortest distance from a node to one of its ancestors, ``-1``
+        if ``target_id`` isn't an ancestor of ``source_id``.
+        """
+        if (source := self.__node_numbers.get(source_id)) is None:
+            return -1
+        if source_id == target_id:
+            return 0
+        if (target := self.__node_numbers.get(target_id)) is None:
+            return -1
+        end = self.__ancestor_offsets[source+1]
+        n = bisect.bisect_left(self.__ancestors, target, self.__ancestor_offsets[source], end)
+        if n < end and self.__ancestors[n] == target:
+            return self.__distances[n]
+        return -1
+
+    def label(self, node_id: str) -> str:
+    #====================================
+        label = self.__node_labels[self.__node_numbers[node_id]]
+        return str(self.__label_bytes[self.__label_offsets[label]:self.__label_offsets[label+1]], 'utf-8')
+
+    def labels(self) -> Iterator[tuple[str, str]]:
+    #=============================================
+        """
+        The id and label of each node that has a label.
+        """
+        for (node_id, node) in self.__node_numbers.items():
+            label = self.__node_labels[node]
+            if self.__label_offsets[label] < self.__label_offsets[label+1]:
+                yield (node_id, str(self.__label_bytes[self.__label_offsets[label]:self.__label_offsets[label+1]], 'utf-8'))
+
+    def node_id(self, node: int) -> str:
+    #===================================
+        return str(self.__id_bytes[self.__id_offsets[node]:self.__id_offsets[node+1]], 'utf-8')
+
+    def nx_graph(self) -> nx.DiGraph:
+    #================================
+        """
+        The hierarchy as a NetworkX graph, with nodes and edges in the order
+        of the graph it was saved from.
+        """
+        graph = nx.DiGraph()
+        node_ids = list(self.__node_numbers)
+        graph.add_nodes_from((node_id, {'label': self.label(node_id)}) for node_id in node_ids)
+        graph.add_edges_from((node_ids[node], node_ids[self.__edge_targets[n]])
+                                for node in range(len(node_ids))
+                                    for n in range(self.__edge_offsets[node], self.__edge_offsets[node+1]))
+        return graph
+
+    @staticmethod
+    def save(graph: nx.DiGraph, filename: str):
+    #==========================================
+        node_ids: list[str] = list(graph.nodes)
+        node_numbers = {node_id: number for (number, node_id) in enumerate(node_ids)}
+        successors = [[node_numbers[successor] for successor in graph.successors(node_id)]
+                        for node_id in node_ids]
+        label_numbers: dict[str, int] = {}
+        node_labels = array('I', [label_numbers.setdefault(str(graph.nodes[node_id].get('label', node_id)),
+                                                           len(label_numbers))
+                                    for node_id in node_ids])
+        (id_offsets, id_bytes) = SparcGraph.__string_table(node_ids)
+        (label_offsets, label_bytes) = SparcGraph.__string_table(list(label_numbers))
+        edge_offsets = array('I', [0])
+        edge_targets = array('I')
+        for targets in successors:
+            edge_targets.extend(targets)
+            edge_offsets.append(len(edge_targets))
+        ancestor_offsets = array('I', [0])
+        ancestors = array('I')
+        distances = array('H')
+        for node in range(len(node_ids)):
+            ancestor_distances = SparcGraph.__search(node, successors)
+            for ancestor in sorted(ancestor_distances):
+                ancestors.append(ancestor)
+                distances.append(ancestor_distances[ancestor])
+            ancestor_offsets.append(len(ancestors))
+        temp_file = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_file, 'wb') as fp:
+            fp.write(SPARC_GRAPH_HEADER.pack(SPARC_GRAPH_MAGIC, BYTE_ORDER_MARK,
+                                             len(node_ids), len(label_numbers), len(edge_targets),
+                                             len(ancestors), len(id_bytes), len(label_bytes)))
+            for section in [id_offsets, node_labels, label_offsets, edge_offsets, edge_targets,
+                            ancestor_offsets, ancestors, distances, id_bytes, label_bytes]:
+                data = section.tobytes() if isinstance(section, array) else section
+                fp.write(data)
+                fp.write(bytes(-len(data) % 4))
+        os.replace(temp_file, filename)
+
+    @staticmethod
+    def __search(node: int, successors: list[list[int]]) -> dict[int, int]:
+    #======================================================================
+        distances = {}
+        queue = deque([(node, 0)])
+        seen = {node}
+        while queue:
+            (current, distance) = queue.popleft()
+            for successor in successors[current]:
+                if successor not in seen:
+                    seen.add(successor)
+                    distances[successor] = distance + 1
+                    queue.append((successor, distance + 1))
+        return distances
+
+    @staticmethod
+    def __string_table(strings: list[str]) -> tuple[array, bytes]:
+    #=============================================================
+        offsets = array('I', [0])
+        encoded = bytearray()
+        for string in strings:
+            encoded.extend(string.encode('utf-8'))
+            offsets.append(len(encoded))
+        return (offsets, bytes(encoded))
+
+#===============================================================================
+
 class SparcHierarchy:
     def __init__(self, uberon_source: str, interlex_source: str):
-        hierarchy_file = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY)
+        self.__load_times: dict[str, float] = {}
+        self.__node_link_json = None
+        self.__lock = threading.Lock()
+        graph_file = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_GRAPH)
+        start_time = time.perf_counter()
         try:
-            with open(hierarchy_file) as fp:
-                graph_json = json.load(fp)
-                self.__graph = nx.node_link_graph(graph_json, directed=True)
-                return
-        except Exception:
+            self.__graph = SparcGraph(graph_file)
+            self.__load_times['cached'] = time.perf_counter() - start_time
+            return
+        except (OSError, ValueError):
             pass
-        self.__graph = UberonGraph(uberon_source)
-        self.__add_ilx_terms(interlex_source)
-        graph_json = nx.node_link_data(self.__graph)
-        with open(hierarchy_file, 'w') as fp:
-            json.dump(graph_json, fp)
-
-    def __add_ilx_terms(self, interlex_source: str):
-    #===============================================
+        # Convert a hierarchy cached in the previous format, otherwise build it
+        try:
+            with open(os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY)) as fp:
+                graph = nx.node_link_graph(json.load(fp), directed=True)
+            self.__load_times['json'] = time.perf_counter() - start_time
+        except Exception:
+            graph = self.__build(uberon_source, interlex_source)
+        start_time = time.perf_counter()
+        SparcGraph.save(graph, graph_file)
+        self.__graph = SparcGraph(graph_file)
+        self.__load_times['save'] = time.perf_counter() - start_time
+
+    def __build(self, uberon_source: str, interlex_source: str) -> nx.DiGraph:
+    #=========================================================================
+        start_time = time.perf_counter()
+        graph = UberonGraph(uberon_source)
+        # Each node's distance to the anatomical root, found with a single search
+        # and then extended as Interlex terms are added
+        depths = (dict(nx.single_target_shortest_path_length(graph, ANATOMICAL_ROOT.id))
+                    if ANATOMICAL_ROOT.id in graph else {})
+        self.__load_times['uberon'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        self.__add_ilx_terms(graph, depths, interlex_source)
+        self.__load_times['interlex'] = time.perf_counter() - start_time
+        return graph
+
+    @property
+    def load_times(self) -> dict[str, float]:
+        """
+        The time, in seconds, taken by each phase of loading the hierarchy.
+        """
+        return self.__load_times
+
+    def __add_ilx_terms(self, graph: nx.DiGraph, depths: dict[str, int], interlex_source: str):
+    #===========================================================================================
         ilx_terms = IlxTerms(interlex_source)
         have_ilx_parents = []
         for ilx_term in ilx_terms.term_list():
             if ilx_term.have_ilx_parents:
                 have_ilx_parents.append(ilx_term)
             else:
-                self.__add_ilx_child(ilx_term)
+                self.__add_ilx_child(graph, depths, ilx_term)
         depth = 0
         while depth < 3 and len(have_ilx_parents):
             new_parents = []
             for ilx_term in have_ilx_parents:
                 # Are all parents now in the graph?
-                if functools.reduce(lambda in_graph, p: in_graph and p in self.__graph,
+                if functools.reduce(lambda in_graph, p: in_graph and p in graph,
                                     ilx_term.parents, True):
-                    self.__add_ilx_child(ilx_term)
+                    self.__add_ilx_child(graph, depths, ilx_term)
                 else:
                     new_parents.append(ilx_term)
             have_ilx_parents = new_parents
@@ -267,19 +522,29 @@ class SparcHierarchy:
         if len(have_ilx_parents):
             raise ValueError('Some Interlex parts are too deeply nested')
 
-    def __add_ilx_child(self, ilx: IlxTerm):
-    #=======================================
-        self.__graph.add_node(ilx.uri.id, label=ilx.label if ilx.label else ilx.uri)
+    def __add_ilx_child(self, graph: nx.DiGraph, depths: dict[str, int], ilx: IlxTerm):
+    #==================================================================================
+        graph.add_node(ilx.uri.id, label=ilx.label if ilx.label else ilx.uri)
         furthest_term = None
         max_parent_distance = 0
         for parent in ilx.parents:
-            if parent.id in self.__graph:
-                distance = self.distance_to_root(parent)
-                if distance > max_parent_distance:
-                    furthest_term = parent
-                    max_parent_distance = distance
+            distance = depths.get(parent.id, -1)
+            if distance > max_parent_distance:
+                furthest_term = parent
+                max_parent_distance = distance
         if furthest_term is not None:
-            self.__graph.add_edge(ilx.uri.id, furthest_term.id)
+            # A term is added once for each parent it's been given so far, so
+            # has an edge to each furthest parent and is nearest to the root
+            # through the closest of them
+            graph.add_edge(ilx.uri.id, furthest_term.id)
+            depths[ilx.uri.id] = min(depths.get(ilx.uri.id, math.inf), max_parent_distance + 1)
+
+    def ancestors(self, term: Uri) -> Iterator[tuple[str, int]]:
+    #==========================================================
+        """
+        The terms ``term`` is part of and their distance from it.
+        """
+        return self.__graph.ancestors(term.id)
 
     def distance_to_root(self, source):
     #==================================
@@ -291,23 +556,88 @@ class SparcHierarchy:
 
     def label(self, term: Uri) -> str:
     #=================================
-        return self.__graph.nodes[term.id]['label']
+        return self.__graph.label(term.id)
+
+    def labels(self) -> Iterator[tuple[str, str]]:
+    #=============================================
+        """
+        The id and label of each term in the hierarchy that has a label.
+        """
+        return self.__graph.labels()
+
+    def node_link_json(self) -> bytes:
+    #=================================
+        """
+        The hierarchy as NetworkX node-link JSON, generated when first needed.
+        """
+        with self.__lock:
+            if self.__node_link_json is None:
+                self.__node_link_json = json.dumps(nx.node_link_data(self.__graph.nx_graph())).encode()
+            return self.__node_link_json
 
     def path_length(self, source, target):
     #=====================================
-        try:
-            return nx.shortest_path_length(self.__graph, source.id, target.id)
-        except (nx.NetworkXNoPath, nx.NodeNotFound):
-            pass
-        return -1
+        return self.__graph.distance(source.id, target.id)
 
 #===============================================================================
 
 class AnatomicalHierarchy:
+    """
+    Hierarchies of the anatomical terms used by flatmaps.
+
+    The SPARC hierarchy these are derived from is only loaded when it is
+    first needed, or when :meth:`load` is called in the background.
+    """
     def __init__(self):
-        self.__sparc_hierarchy = SparcHierarchy(UBERON_ONTOLOGY, NPO_ONTOLOGY)
+        self.__sparc_hierarchy = None
+        self.__load_error: Optional[str] = None
+        self.__lock = threading.Lock()
+        self.__map_hierarchies = SingleFlight()
 
-    def get_hierachy(self, flatmap: str):
+    @property
+    def load_error(self) -> Optional[str]:
+        """
+        Why the SPARC hierarchy couldn't be loaded, if its last load failed.
+        """
+        return self.__load_error
+
+    @property
+    def ready(self) -> bool:
+        return self.__sparc_hierarchy is not None
+
+    def load(self) -> SparcHierarchy:
+    #================================
+        with self.__lock:
+            if self.__sparc_hierarchy is None:
+                try:
+                    self.__sparc_hierarchy = SparcHierarchy(UBERON_ONTOLOGY, NPO_ONTOLOGY)
+                except Exception as error:
+                    self.__load_error = str(error) or error.__class__.__name__
+                    raise
+                self.__load_error = None
+            return self.__sparc_hierarchy
+
+    def sparc_terms_json(self) -> bytes:
+    #===================================
+        return self.load().node_link_json()
+
+    def get_hierachy(self, flatmap: str, wait: bool=True):
+        """
+        Get a flatmap's hierarchy of anatomical terms, raising
+        :class:`HierarchyNotReady` if the hierarchy has to be built,
+        ``wait`` is ``False``, and the SPARC hierarchy isn't yet loaded.
+
+        Concurrent requests for a hierarchy that has to be built share
+        the one build.
+        """
+        if (hierarchy := self.__cached_hierarchy(flatmap)) is not None:
+            return hierarchy
+        if not (wait or self.ready):
+            raise HierarchyNotReady(f'Anatomical hierarchy is not loaded for {flatmap}')
+        return self.__map_hierarchies.call(flatmap, self.__build_hierarchy, flatmap)
+
+    def __cached_hierarchy(self, flatmap: str) -> Optional[dict]:
+    #============================================================
         hierarchy_file = os.path.join(settings['FLATMAP_ROOT'], flatmap, CACHED_MAP_HIERARCHY)
         try:
             with open(hierarchy_file) as fp:
@@ -316,34 +646,46 @@ class AnatomicalHierarchy:
                     return hierarchy
         except Exception:
             pass
+        return None
 
+    def __build_hierarchy(self, flatmap: str) -> dict:
+    #=================================================
+        # The hierarchy may have been saved since we last looked
+        if (hierarchy := self.__cached_hierarchy(flatmap)) is not None:
+            return hierarchy
+        hierarchy_file = os.path.join(settings['FLATMAP_ROOT'], flatmap, CACHED_MAP_HIERARCHY)
+        sparc_hierarchy = self.load()
         hierarchy_graph = nx.DiGraph()
         hierarchy_graph.add_node(ANATOMICAL_ROOT.id,
-            label=self.__sparc_hierarchy.label(ANATOMICAL_ROOT),
+            label=sparc_hierarchy.label(ANATOMICAL_ROOT),
             distance=0)
         hierarchy_graph.add_node(BODY_PROPER.id,
-            label=self.__sparc_hierarchy.label(BODY_PROPER))
+            label=sparc_hierarchy.label(BODY_PROPER))
 
         # Nodes on the graph are SPARC terms, with attributes of the term's label and its distance to
         # a common ``anatomical root``
         map_terms = set(Uri(term) for term in
                         [ann.get('models') for ann in get_metadata(flatmap, 'annotations').values()]
-                            if self.__sparc_hierarchy.has(term))
+                            if sparc_hierarchy.has(term))
         for term in map_terms:
-            distance = self.__sparc_hierarchy.distance_to_root(term)
+            distance = sparc_hierarchy.distance_to_root(term)
             if distance > 0:
                 hierarchy_graph.add_node(term.id,
-                    label=self.__sparc_hierarchy.label(term),
+                    label=sparc_hierarchy.label(term),
                     distance=distance)
 
         # Find the shortest path between each pair of SPARC terms used in the flatmap,
         # including to the ANATOMICAL_ROOT node, and if a path exists, add an edge to
-        # the graph
+        # the graph. Edges are added in the same order as a search over all pairs of
+        # terms would find them.
         map_terms.add(ANATOMICAL_ROOT)
-        for source, target in itertools.permutations(map_terms, 2):
-            path_length = self.__sparc_hierarchy.path_length(source, target)
-            if path_length > 0:
-                hierarchy_graph.add_edge(source.id, target.id, parent_distance=path_length)
+        term_order = {term.id: n for (n, term) in enumerate(map_terms)}
+        for source in map_terms:
+            parents = sorted((term_order[ancestor], ancestor, distance)
+                                for (ancestor, distance) in sparc_hierarchy.ancestors(source)
+                                    if ancestor in term_order and distance > 0)
+            for (_, target, path_length) in parents:
+                hierarchy_graph.add_edge(source.id, target, parent_distance=path_length)
 
         # For each term used by the flatmap find the closest term(s) it is connected to and
         # delete edges connecting to more distant terms
@@ -365,8 +707,7 @@ class AnatomicalHierarchy:
         hierarchy_tree = Arborescence(hierarchy_graph, ANATOMICAL_ROOT, BODY_PROPER).tree
         hierarchy_tree.graph['version'] = TREE_VERSION  # type: ignore
         hierarchy = nx.node_link_data(hierarchy_tree)
-        with open(hierarchy_file, 'w') as fp:
-            json.dump(hierarchy, fp)
+        save_json(hierarchy, hierarchy_file)
         return hierarchy
 
 #===============================================================================
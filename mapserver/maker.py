@@ -25,6 +25,7 @@ import os
 import queue
 import sys
 import threading
+from typing import Callable, Optional
 import uuid
 
 #===============================================================================
@@ -33,6 +34,7 @@ import uvloop
 
 #===============================================================================
 
+from .executor import run_db
 from .settings import settings
 
 from mapmaker import MapMaker
@@ -43,6 +45,13 @@ import mapmaker.utils as utils
 def log_file(pid):
     return os.path.join(settings['MAPMAKER_LOGS'], '{}.log'.format(pid))
 
+def read_log_file(pid):
+    filename = log_file(pid)
+    if os.path.exists(filename):
+        with open(filename) as fp:
+            return fp.read()
+    return f'Missing log file... {filename}'
+
 #===============================================================================
 
 def _run_in_loop(func, args):
@@ -127,8 +136,9 @@ class MakerProcess(multiprocessing.Process):
 
 class Manager(threading.Thread):
     """A thread to manage flatmap generation"""
-    def __init__(self):
+    def __init__(self, on_map_made: Optional[Callable[[], None]]=None):
         super().__init__(name='maker-thread')
+        self.__on_map_made = on_map_made
         self.__map_dir = None
         self.__processes_by_id: dict[str, MakerProcess] = {}
         self.__running_processes: list[str] = []
@@ -143,19 +153,23 @@ class Manager(threading.Thread):
         self.__loop = uvloop.new_event_loop()
         self.start()
 
+    def call(self, coroutine):
+    #=========================
+        """
+        Run one of our coroutines in our thread, from another thread, and
+        wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
     async def full_log(self, pid):
     #=======================
-        filename = log_file(pid)
-        if os.path.exists(filename):
-            with open(filename) as fp:
-                return fp.read()
-        return f'Missing log file... {filename}'
+        return await run_db(read_log_file, pid)
 
     async def get_log(self, id, start_line=1):
     #=========================================
         if id in self.__processes_by_id:
             process = self.__processes_by_id[id]
-            log_lines = process.get_log(start_line)
+            log_lines = await run_db(process.get_log, start_line)
             if process.completed and process.last_log_lines:
                 await settings['LOGGER'].info('\n'.join(process.last_log_lines))
             return log_lines
@@ -196,6 +210,8 @@ class Manager(threading.Thread):
                     else:
                         process.close()
                         await settings['LOGGER'].info(f'Finished mapmaker process: {process.name}')
+                        if process.status == 'terminated' and self.__on_map_made is not None:
+                            self.__on_map_made()
                 self.__running_processes = still_running
             if len(self.__running_processes) == 0:
                 try:
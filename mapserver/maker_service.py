@@ -0,0 +1,128 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from multiprocessing.managers import BaseManager
+import threading
+from typing import TYPE_CHECKING
+
+#===============================================================================
+
+from .executor import run_network
+
+if TYPE_CHECKING:
+    from .maker import Manager
+
+#===============================================================================
+
+class MakerService:
+    """
+    Access to a ``Manager``, for server processes other than the one
+    running the manager.
+    """
+    def __init__(self, manager: 'Manager'):
+        self.__manager = manager
+
+    def full_log(self, pid) -> str:
+    #==============================
+        return self.__manager.call(self.__manager.full_log(pid))
+
+    def get_log(self, id, start_line=1) -> str:
+    #==========================================
+        return self.__manager.call(self.__manager.get_log(id, start_line))
+
+    def make(self, params) -> dict:
+    #==============================
+        return self.__manager.call(self.__manager.make(params))
+
+    def status(self, id) -> dict:
+    #============================
+        return self.__manager.call(self.__manager.status(id))
+
+#===============================================================================
+
+class MakerServiceManager(BaseManager):
+    pass
+
+class MakerServiceClient(BaseManager):
+    pass
+
+MakerServiceClient.register('maker_service')
+
+def serve_manager(manager: 'Manager', address: str, authkey: bytes):
+#===================================================================
+    """
+    Make a ``Manager`` available to other processes, with the service
+    running in a daemon thread.
+    """
+    service = MakerService(manager)
+    MakerServiceManager.register('maker_service', callable=lambda: service)
+    server = MakerServiceManager(address=address, authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name='maker-service', daemon=True).start()
+
+#===============================================================================
+
+class RemoteManager:
+    """
+    A proxy for a ``Manager`` running in another process, with the same
+    interface as a ``Manager``.
+    """
+    def __init__(self, address: str, authkey: bytes):
+        self.__address = address
+        self.__authkey = authkey
+        self.__service = None
+        self.__lock = threading.Lock()
+
+    async def full_log(self, pid):
+    #=============================
+        return await run_network(self.__call, 'full_log', pid)
+
+    async def get_log(self, id, start_line=1):
+    #=========================================
+        return await run_network(self.__call, 'get_log', id, start_line)
+
+    async def make(self, params) -> dict:
+    #====================================
+        return await run_network(self.__call, 'make', params)
+
+    async def status(self, id) -> dict:
+    #==================================
+        return await run_network(self.__call, 'status', id)
+
+    def terminate(self):
+    #===================
+        pass
+
+    def __call(self, method: str, *args):
+    #====================================
+        with self.__lock:
+            if self.__service is None:
+                client = MakerServiceClient(address=self.__address, authkey=self.__authkey)
+                client.connect()
+                self.__service = client.maker_service()   # type: ignore
+            service = self.__service
+        try:
+            return getattr(service, method)(*args)
+        except (ConnectionError, EOFError):
+            # Reconnect next time
+            with self.__lock:
+                self.__service = None
+            raise
+
+#===============================================================================
@@ -0,0 +1,289 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections import OrderedDict, defaultdict
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+from typing import Optional
+
+#===============================================================================
+
+from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
+from landez.util import flip_y
+
+#===============================================================================
+
+# The maximum number of tile databases kept open at any one time
+
+MBTILES_POOL_SIZE = int(os.environ.get('MBTILES_POOL_SIZE', '64'))
+
+# The memory budget, in bytes, for recently used tiles; ``0`` disables caching
+
+TILE_CACHE_SIZE = int(os.environ.get('TILE_CACHE_SIZE', str(64*1024*1024)))
+
+# Nominal size for a cache entry that records a tile doesn't exist
+
+MISSING_TILE_SIZE = 64
+
+#===============================================================================
+
+TILE_QUERY = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+#===============================================================================
+
+def is_gzipped(data: bytes) -> bool:
+#===================================
+    return data[:2] == GZIP_MAGIC
+
+#===============================================================================
+
+def file_key(filename: str) -> tuple[int, int, int]:
+#==================================================
+    """
+    Identify a particular version of a file, so that we can tell when a map
+    has been remade.
+    """
+    stat = os.stat(filename)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+#===============================================================================
+
+class TileDatabase(MBTilesReader):
+    """
+    Long-lived, read-only connections to an MBTiles database.
+
+    The database is opened as ``immutable`` so that SQLite doesn't lock nor
+    check for changes made by other connections. Each thread reading the
+    database has its own connection, so that reads of a map by different
+    executor threads aren't serialised on a single connection. Statements
+    are prepared once and then reused from each connection's statement cache.
+    """
+    def __init__(self, filename: str, key: tuple[int, int, int]):
+        super().__init__(filename)
+        self.__key = key
+        self.__compressed = None
+        self.__uri = f'{pathlib.Path(filename).resolve().as_uri()}?mode=ro&immutable=1'
+        self.__local = threading.local()
+        self.__connections: list[sqlite3.Connection] = []
+        self.__lock = threading.Lock()
+        self.__connection()
+
+    def __del__(self):
+        # Connections are closed when the last user of the database releases it
+        for connection in self.__connections:
+            connection.close()
+
+    @property
+    def connections(self) -> int:
+        return len(self.__connections)
+
+    @property
+    def compressed(self) -> bool:
+        """
+        Are tiles stored gzipped? Only looked up the first time we are asked.
+        """
+        if self.__compressed is None:
+            try:
+                row = self._query("SELECT value FROM metadata WHERE name='compressed'").fetchone()
+                self.__compressed = row is not None and bool(json.loads(row[0]))
+            except (InvalidFormatError, json.JSONDecodeError):
+                self.__compressed = False
+        return self.__compressed
+
+    @property
+    def key(self) -> tuple[int, int, int]:
+        return self.__key
+
+    def __connection(self) -> sqlite3.Connection:
+    #============================================
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            try:
+                # Only used by this thread but closed by whichever thread releases the database
+                connection = sqlite3.connect(self.__uri, uri=True, check_same_thread=False)
+            except sqlite3.Error as e:
+                raise InvalidFormatError(f'{e} while opening {self.filename}')
+            with self.__lock:
+                self.__connections.append(connection)
+            self.__local.connection = connection
+        return connection
+
+    def _query(self, sql, *args):
+    #============================
+        try:
+            return self.__connection().execute(' '.join(sql.split()), *args)
+        except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+            raise InvalidFormatError(f'{e} while reading {self.filename}')
+
+    def tile(self, z, x, y):
+    #=======================
+        row = self._query(TILE_QUERY, (z, x, flip_y(int(y), int(z)))).fetchone()
+        if row is None:
+            raise ExtractionError(f'Could not extract tile {(z, x, y)} from {self.filename}')
+        return row[0]
+
+#===============================================================================
+
+class TileDatabasePool:
+    """
+    Open tile databases, keyed by filename, with the least recently used
+    database closed when the pool is full.
+    """
+    def __init__(self, max_size: int=MBTILES_POOL_SIZE):
+        self.__max_size = max(1, max_size)
+        self.__databases: OrderedDict[str, TileDatabase] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, filename: str) -> TileDatabase:
+    #============================================
+        try:
+            key = file_key(filename)
+        except OSError:
+            raise InvalidFormatError(f'Missing tile database: {filename}')
+        with self.__lock:
+            database = self.__databases.get(filename)
+            if database is not None and database.key == key:
+                self.__databases.move_to_end(filename)
+                return database
+            # The file is new or has been remade; any old connection
+            # is closed when its last user releases it
+            database = TileDatabase(filename, key)
+            self.__databases[filename] = database
+            self.__databases.move_to_end(filename)
+            while len(self.__databases) > self.__max_size:
+                self.__databases.popitem(last=False)
+            return database
+
+    def release_changed(self) -> list[str]:
+    #======================================
+        """
+        Forget about databases whose files have been remade or removed, so
+        that they are closed once no longer in use, and return their filenames.
+        """
+        with self.__lock:
+            databases = list(self.__databases.items())
+        changed = []
+        for (filename, database) in databases:
+            try:
+                key = file_key(filename)
+            except OSError:
+                key = None
+            if key != database.key:
+                changed.append((filename, database))
+        with self.__lock:
+            for (filename, database) in changed:
+                # The database may have been reopened since we looked
+                if self.__databases.get(filename) is database:
+                    del self.__databases[filename]
+        return [filename for (filename, _) in changed]
+
+#===============================================================================
+
+TileKey = tuple[str, str, int, int, int]
+
+class TileCache:
+    """
+    Recently used tiles, as they are stored in their tile database, kept
+    within a memory budget with the least recently used tiles evicted first.
+
+    Tiles are keyed by ``(map_id, layer, z, x, y)``. All of a map's tiles are
+    dropped when any of its tile databases are seen to have changed.
+    """
+    def __init__(self, max_bytes: int=TILE_CACHE_SIZE):
+        self.__max_bytes = max_bytes
+        self.__tiles: OrderedDict[TileKey, tuple[tuple[int, int, int], Optional[bytes]]] = OrderedDict()
+        self.__map_tiles: defaultdict[str, set[TileKey]] = defaultdict(set)
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+                'tiles': len(self.__tiles),
+                'bytes': self.__size,
+                'budget': self.__max_bytes
+            }
+
+    def invalidate(self, map_id: str):
+    #==================================
+        with self.__lock:
+            self.__invalidate(map_id)
+
+    def tile(self, tile_reader: TileDatabase, map_id: str, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+    #=============================================================================================================
+        """
+        Get a tile, returning ``None`` if the tile doesn't exist.
+        """
+        key = (map_id, layer, z, x, y)
+        with self.__lock:
+            if (entry := self.__tiles.get(key)) is not None:
+                if entry[0] == tile_reader.key:
+                    self.__hits += 1
+                    self.__tiles.move_to_end(key)
+                    return entry[1]
+                self.__invalidate(map_id)
+            self.__misses += 1
+        try:
+            tile_bytes = tile_reader.tile(z, x, y)
+        except ExtractionError:
+            tile_bytes = None
+        if self.__max_bytes > 0:
+            with self.__lock:
+                if key not in self.__tiles:
+                    self.__tiles[key] = (tile_reader.key, tile_bytes)
+                    self.__map_tiles[map_id].add(key)
+                    self.__size += self.__entry_size(tile_bytes)
+                    while self.__size > self.__max_bytes and len(self.__tiles):
+                        (old_key, (_, old_bytes)) = self.__tiles.popitem(last=False)
+                        self.__map_tiles[old_key[0]].discard(old_key)
+                        self.__size -= self.__entry_size(old_bytes)
+                        self.__evictions += 1
+        return tile_bytes
+
+    @staticmethod
+    def __entry_size(tile_bytes: Optional[bytes]) -> int:
+    #====================================================
+        return MISSING_TILE_SIZE if tile_bytes is None else len(tile_bytes)
+
+    def __invalidate(self, map_id: str):
+    #===================================
+        for key in self.__map_tiles.pop(map_id, set()):
+            if (entry := self.__tiles.pop(key, None)) is not None:
+                self.__size -= self.__entry_size(entry[1])
+
+#===============================================================================
+
+tile_databases = TileDatabasePool()
+
+tile_cache = TileCache()
+
+#===============================================================================
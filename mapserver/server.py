@@ -18,14 +18,21 @@
 #
 #===============================================================================
 
+import asyncio
+import base64
+from datetime import datetime, timezone
+import functools
 import gzip
+import hashlib
 import io
 import json
 import os
 import os.path
-import pathlib
 import sqlite3
 import sys
+import threading
+import time
+from typing import Iterator, Optional
 
 #===============================================================================
 
@@ -35,9 +42,16 @@ from quart_cors import cors
 
 #===============================================================================
 
-from .knowledge import KnowledgeStore, get_metadata, read_metadata
-from .knowledge.hierarchy import AnatomicalHierarchy, CACHED_SPARC_HIERARCHY
+from .catalogue import MapCatalogue
+from .executor import background_executor, executor_stats, run_cpu, run_db, run_network
+from .executor import run_writer, writer_executor
+from .knowledge import cacheable_query, get_metadata, get_metadata_json, knowledge_stores, metadata_cache
+from .knowledge import LABEL_CACHE_SIZE, label_cache, query_result_cache, query_statistics, sql_fingerprint
+from .knowledge.hierarchy import AnatomicalHierarchy, HierarchyNotReady
+from .mbtiles import file_key, is_gzipped, tile_cache, tile_databases
 from .settings import settings
+from .singleflight import SingleFlight
+from .streaming import stream_in_thread
 from . import __version__
 
 #===============================================================================
@@ -75,6 +89,26 @@ settings['MAPMAKER_LOGS'] = normalise_path(MAPMAKER_LOGS)
 settings['ANNOTATOR_TOKENS'] = os.environ.get('ANNOTATOR_TOKENS', '').split()
 settings['MAPMAKER_TOKENS'] = os.environ.get('MAPMAKER_TOKENS', '').split()
 
+#===============================================================================
+
+# The most rows returned for a knowledge query, with any others fetched
+# using the query's ``next`` cursor
+
+KNOWLEDGE_QUERY_ROWS = int(os.environ.get('KNOWLEDGE_QUERY_ROWS', '10000'))
+
+# How long, in seconds, a knowledge query may run for
+
+KNOWLEDGE_QUERY_TIMEOUT = float(os.environ.get('KNOWLEDGE_QUERY_TIMEOUT', '10'))
+
+# The most entities whose labels may be asked for in one request
+
+KNOWLEDGE_LABEL_BATCH = int(os.environ.get('KNOWLEDGE_LABEL_BATCH', '1000'))
+
+# How often, in seconds, each server process looks for maps that have been
+# remade, or removed, by any process
+
+REMADE_MAP_CHECK_INTERVAL = float(os.environ.get('REMADE_MAP_CHECK_INTERVAL', '10'))
+
 #===============================================================================
 """
 If a file with this name exists in the map's output directory then the map
@@ -90,10 +124,25 @@ os.environ['OPENCV_IO_ENABLE_JASPER'] = '1'
 
 #===============================================================================
 
+# The flatmaps we are serving
+
+map_catalogue = MapCatalogue(settings['FLATMAP_ROOT'], MAKER_SENTINEL)
+
+# Concurrent requests for the same resource share the work of getting it
+
+single_flight = SingleFlight()
+
+#===============================================================================
+
 # Build and cache a hierarchy of anataomical terms used by a flatmap
 
 anatomical_hierarchy = AnatomicalHierarchy()
 
+# The hierarchy is loaded in the background once the server has started, with
+# clients asked to retry after this many seconds if they need it beforehand
+
+HIERARCHY_RETRY_AFTER = 30
+
 #===============================================================================
 
 # Don't import unnecessary packages nor instantiate a Manager when building
@@ -103,7 +152,7 @@ anatomical_hierarchy = AnatomicalHierarchy()
 map_maker = None
 
 if 'sphinx' not in sys.modules:
-    from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
+    from landez.sources import InvalidFormatError
     from PIL import Image
 
 #===============================================================================
@@ -151,6 +200,8 @@ async def send_json(filename):
     try:
         return await quart.send_file(filename, mimetype='application/json')
     except FileNotFoundError:
+        # Not cached as the map may yet have the file
+        quart.g.pop('map_cache', None)
         return quart.jsonify({})
 
 #===============================================================================
@@ -160,21 +211,305 @@ def error_abort(msg):
     app.logger.error(msg)
     quart.abort(501, msg)
 
+def hierarchy_unavailable() -> quart.Response:
+#=============================================
+    if anatomical_hierarchy.load_error is not None:
+        # The reason has been logged
+        return quart.Response('{"error": "anatomical hierarchy failed to load"}', status=500,
+                              mimetype='application/json')
+    return quart.Response('{"error": "anatomical hierarchy is loading"}', status=503,
+                          mimetype='application/json',
+                          headers={'Retry-After': str(HIERARCHY_RETRY_AFTER)})
+
 #===============================================================================
 
-def blank_tile():
+@functools.cache
+def blank_tile() -> bytes:
     tile = Image.new('RGBA', (1, 1), color=(255, 255, 255, 0))
     file = io.BytesIO()
     tile.save(file, 'png')
-    file.seek(0)
-    return file
+    return file.getvalue()
+
+
+#===============================================================================
+
+# Blocking helpers, to be run in an executor thread
+
+def get_vector_tile(map_id: str, z: int, x: int, y: int, accept_gzip: bool) -> tuple[Optional[bytes], bool]:
+#===========================================================================================================
+    """
+    Get a vector tile, and whether it is gzipped, with a stored gzipped tile
+    only decompressed if the client doesn't accept gzip.
+    """
+    mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, 'index.mbtiles')
+    tile_reader = tile_databases.get(mbtiles)
+    tile_bytes = tile_cache.tile(tile_reader, map_id, 'index', z, x, y)
+    if tile_bytes is not None and tile_reader.compressed and is_gzipped(tile_bytes):
+        if accept_gzip:
+            return (tile_bytes, True)
+        tile_bytes = gzip.decompress(tile_bytes)
+    return (tile_bytes, False)
+
+def get_image_tile(map_id: str, layer: str, z: int, x: int, y: int) -> Optional[bytes]:
+#======================================================================================
+    mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, '{}.mbtiles'.format(layer))
+    reader = tile_databases.get(mbtiles)
+    return tile_cache.tile(reader, map_id, layer, z, x, y)
+
+def catalogue_listing(url_prefix: str) -> bytes:
+#===============================================
+    for error in map_catalogue.refresh():
+        app.logger.error(error)
+    return map_catalogue.listing(url_prefix)
+
+def termgraph_json(map_id: str) -> bytes:
+#========================================
+    return json.dumps(anatomical_hierarchy.get_hierachy(map_id, wait=False)).encode()
+
+def stored_knowledge_label(entity: str) -> Optional[str]:
+#=======================================================
+    return knowledge_stores.reader().stored_label(entity)
+
+def stored_knowledge_labels(entities: list[str]) -> dict[str, str]:
+#=================================================================
+    return knowledge_stores.reader().stored_labels(entities)
+
+def cache_stored_knowledge_labels() -> int:
+#=========================================
+    return label_cache.warm(knowledge_stores.reader().stored_label_items(LABEL_CACHE_SIZE))
+
+def fetched_knowledge_label(entity: str) -> str:
+#===============================================
+    # Called in a ``network`` executor thread, with labels found elsewhere
+    # saved together afterwards
+    return knowledge_stores.reader().label(entity)
+
+def save_knowledge_labels(labels: dict[str, str]):
+#=================================================
+    # Only called in the writer thread
+    knowledge_stores.writer().save_labels(labels)
+
+def knowledge_query_json(stopped: threading.Event, sql: str, params: list, max_rows: int,
+                         skip_rows: int, client: Optional[str]) -> Iterator[bytes]:
+#=======================================================================================
+    """
+    Generate the JSON result of a knowledge query, reading rows as they
+    are sent. The results of queries that only read are cached until the
+    knowledge base changes.
+    """
+    start_time = time.perf_counter()
+    fingerprint = sql_fingerprint(sql)
+    cache_key = None
+    if cacheable_query(sql):
+        data_version = knowledge_stores.data_version()
+        # Keyed by the exact SQL as normalising it could change a quoted literal
+        cache_key = (sql, json.dumps(params), max_rows, skip_rows)
+        if (cached := query_result_cache.get(cache_key, data_version)) is not None:
+            yield cached[0]
+            query_statistics.record(fingerprint, time.perf_counter() - start_time, cached[1], cached=True)
+            return
+    # Only time spent reading the query's rows counts towards its time limit,
+    # not time waiting for the client to take them
+    deadline = time.monotonic() + KNOWLEDGE_QUERY_TIMEOUT
+    waiting = 0.0
+    rows = knowledge_stores.reader().query_rows(sql, params, max_rows=max_rows, skip_rows=skip_rows,
+        interrupt=lambda: stopped.is_set() or time.monotonic() - waiting > deadline)
+    count = 0
+
+    def result_json():
+        nonlocal count
+        if (started := rows.error is None):
+            yield f'{{"keys": {json.dumps(rows.keys)}, "values": ['.encode()
+            for row in rows:
+                yield (b', ' if count else b'') + json.dumps(row).encode()
+                count += 1
+            yield b']'
+            if rows.more:
+                yield f', "next": {json.dumps(query_cursor(sql, params, skip_rows + count))}'.encode()
+        if (error := rows.error) is not None:
+            if error == 'interrupted' and not stopped.is_set():
+                error = f'Query took longer than {KNOWLEDGE_QUERY_TIMEOUT} seconds'
+            app.logger.warning(f'SQL: {error}')
+            yield f'{", " if started else "{"}"error": {json.dumps(error)}'.encode()
+        yield b'}'
+
+    # Keep a copy of what is sent if the result may be cached
+    result: Optional[bytearray] = bytearray() if cache_key is not None else None
+    for piece in result_json():
+        paused = time.monotonic()
+        yield piece
+        waiting += time.monotonic() - paused
+        if result is not None:
+            result.extend(piece)
+            if len(result) > query_result_cache.max_entry_size:
+                result = None
+    elapsed = time.perf_counter() - start_time
+    if result is not None and rows.error is None:
+        query_result_cache.put(cache_key, data_version, bytes(result), count)
+    query_statistics.record(fingerprint, elapsed, count, error=rows.error is not None)
+    app.logger.info('SQL from {}: {:.3f}s, {} rows: {}'.format(client, elapsed, count, ' '.join(str(sql).split())[:200]))
+
+def query_digest(sql: str, params: list) -> str:
+#===============================================
+    return hashlib.sha256(json.dumps([sql, params]).encode()).hexdigest()[:16]
+
+def query_cursor(sql: str, params: list, offset: int) -> str:
+#============================================================
+    """
+    An opaque token for getting the rows of a query starting at ``offset``.
+    """
+    token = json.dumps([offset, query_digest(sql, params)])
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+def query_cursor_offset(cursor: str, sql: str, params: list) -> Optional[int]:
+#=============================================================================
+    try:
+        (offset, digest) = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if digest != query_digest(sql, params) or not isinstance(offset, int) or offset < 0:
+        return None
+    return offset
+
+#===============================================================================
+
+async def map_metadata_json(map_id: str, name: str) -> bytes:
+#============================================================
+    return await single_flight.run(('metadata', map_id, name), run_db, get_metadata_json, map_id, name)
+
+#===============================================================================
+#===============================================================================
+
+# Maps are immutable once made, so responses for a map addressed by its UUID
+# can be cached indefinitely. Responses for other maps have to be revalidated.
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# Tile responses are validated by their content
+
+TILE_ENDPOINTS = ['flatmap.vector_tiles', 'flatmap.image_tiles']
 
 #===============================================================================
 
-def normalise_identifier(id):
-#============================
-    return ':'.join([(s[:-1].lstrip('0') + s[-1])
-                        for s in id.split(':')])
+@functools.lru_cache(maxsize=256)
+def __map_version(map_id: str, key: tuple[int, int, int]) -> Optional[tuple[str, datetime, bool]]:
+#=================================================================================================
+    # ``key`` identifies the version of the map's tile database and so also
+    # ensures our cached result is for the current version of the map
+    try:
+        metadata = get_metadata(map_id, 'metadata')
+    except OSError:
+        metadata = {}
+    except ValueError:
+        metadata = None
+    if not isinstance(metadata, dict):
+        # Without readable metadata we can't tell which version of the map this is
+        app.logger.warning(f'Invalid metadata for map: {map_id}')
+        return None
+    map_uuid = metadata.get('uuid')
+    immutable = isinstance(map_uuid, str) and map_id == map_uuid.split(':')[-1]
+    last_modified = None
+    if (created := metadata.get('created')) is not None:
+        try:
+            last_modified = datetime.fromisoformat(created)
+            if last_modified.tzinfo is None:
+                last_modified = last_modified.replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            pass
+    if last_modified is None:
+        last_modified = datetime.fromtimestamp(key[2]/1e9, tz=timezone.utc)
+    version = f'{map_uuid or metadata.get("id", map_id)}:{created or key}'
+    return (version, last_modified.replace(microsecond=0), immutable)
+
+def map_version(map_id: str) -> Optional[tuple[str, datetime, bool]]:
+#====================================================================
+    """
+    Get a map's version, when it was made, and whether it is addressed by
+    its UUID. There's no version for a map that is being made, as its files
+    are changing, nor for one whose metadata can't be decoded.
+    """
+    map_dir = os.path.join(settings['FLATMAP_ROOT'], map_id)
+    if os.path.exists(os.path.join(map_dir, MAKER_SENTINEL)):
+        return None
+    try:
+        key = file_key(os.path.join(map_dir, 'index.mbtiles'))
+    except OSError:
+        return None
+    return __map_version(map_id, key)
+
+def not_modified(etag: str, last_modified: Optional[datetime]=None) -> bool:
+#===========================================================================
+    if quart.request.if_none_match:
+        return quart.request.if_none_match.contains(etag)
+    return (last_modified is not None
+        and quart.request.if_modified_since is not None
+        and last_modified <= quart.request.if_modified_since)
+
+def not_modified_response(etag: str, cache_control: str) -> quart.Response:
+#==========================================================================
+    response = quart.Response('', status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+#===============================================================================
+
+@flatmap_blueprint.before_request
+async def check_map_etag():
+    """
+    Respond with ``304 Not Modified`` if the client already has the current
+    version of a map resource.
+    """
+    if ((map_id := (quart.request.view_args or {}).get('map_id')) is None
+     or quart.request.endpoint in TILE_ENDPOINTS
+     or (version := await run_db(map_version, map_id)) is None):
+        return None
+    (map_version_id, last_modified, immutable) = version
+    # What is sent for a map depends on the ``Accept`` header
+    variant = quart.request.accept_mimetypes.best if quart.request.endpoint == 'flatmap.map' else ''
+    etag = hashlib.sha256(f'{__version__}:{map_version_id}:{quart.request.path}:{variant}'.encode()).hexdigest()[:32]
+    cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    quart.g.map_cache = (etag, last_modified, cache_control)
+    if not_modified(etag, last_modified):
+        response = not_modified_response(etag, cache_control)
+        if quart.request.endpoint == 'flatmap.map':
+            response.vary.add('Accept')
+        return response
+    return None
+
+@flatmap_blueprint.after_request
+async def add_cache_headers(response: quart.Response) -> quart.Response:
+    """
+    Add validators and caching directives to a map resource.
+    """
+    if response.status_code != 200:
+        return response
+    if quart.request.endpoint in TILE_ENDPOINTS:
+        map_id = quart.request.view_args['map_id']  # type: ignore
+        version = await run_db(map_version, map_id)
+        cache_control = IMMUTABLE_CACHE_CONTROL if version is not None and version[2] else REVALIDATE_CACHE_CONTROL
+        etag = hashlib.blake2b(await response.get_data(), digest_size=16).hexdigest()
+        if not_modified(etag):
+            unchanged = not_modified_response(etag, cache_control)
+            if 'Vary' in response.headers:
+                unchanged.headers['Vary'] = response.headers['Vary']
+            return unchanged
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+    elif (map_cache := quart.g.get('map_cache')) is not None:
+        (etag, last_modified, cache_control) = map_cache
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = cache_control
+        response.headers.pop('Expires', None)
+        if quart.request.endpoint == 'flatmap.map':
+            response.vary.add('Accept')
+    elif (quart.request.view_args or {}).get('map_id') is not None:
+        # The map is being made or doesn't have the file
+        response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+        response.headers.pop('Expires', None)
+    return response
 
 #===============================================================================
 #===============================================================================
@@ -189,68 +524,9 @@ async def maps():
     :>jsonarr string created: when the map was generated
     :>jsonarr string describes: the map's description
     """
-    flatmap_list = []
-    root_path = pathlib.Path(settings['FLATMAP_ROOT'])
-    if root_path.is_dir():
-        for flatmap_dir in root_path.iterdir():
-            index = os.path.join(settings['FLATMAP_ROOT'], flatmap_dir, 'index.json')
-            mbtiles = os.path.join(settings['FLATMAP_ROOT'], flatmap_dir, 'index.mbtiles')
-            map_making = os.path.join(settings['FLATMAP_ROOT'], flatmap_dir, MAKER_SENTINEL)
-            if (os.path.isdir(flatmap_dir) and not os.path.exists(map_making)
-            and os.path.exists(index) and os.path.exists(mbtiles)):
-                with open(index) as fp:
-                    index = json.loads(fp.read())
-                version = index.get('version', 1.0)
-                reader = MBTilesReader(mbtiles)
-                if version >= 1.3:
-                    metadata: dict[str, str] = read_metadata(reader, 'metadata')
-                    if (('id' not in metadata or flatmap_dir.name != metadata['id'])
-                     and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
-                        app.logger.error(f'Flatmap id mismatch: {flatmap_dir}')
-                        continue
-                    flatmap = {
-                        'id': metadata['id'],
-                        'source': metadata['source'],
-                        'version': version
-                    }
-                    if 'uuid' in metadata:
-                        flatmap['uuid'] = metadata['uuid']
-                        id = metadata['uuid']
-                    else:
-                        id = metadata['id']
-                    flatmap['uri'] = f'{quart.request.root_url}{flatmap_blueprint.name}/{id}/'
-                    if 'created' in metadata:
-                        flatmap['created'] = metadata['created']
-                    if 'taxon' in metadata:
-                        flatmap['taxon'] = normalise_identifier(metadata['taxon'])
-                        flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
-                    elif 'describes' in metadata:
-                        flatmap['taxon'] = normalise_identifier(metadata['describes'])
-                        flatmap['describes'] = flatmap['taxon']
-                    if 'biological-sex' in metadata:
-                        flatmap['biologicalSex'] = metadata['biological-sex']
-                    if 'name' in metadata:
-                        flatmap['name'] = metadata['name']
-                else:
-                    source_row = None
-                    try:
-                        source_row = reader._query("SELECT value FROM metadata WHERE name='source'").fetchone()
-                    except (InvalidFormatError, sqlite3.OperationalError):
-                        quart.abort(404, 'Cannot read tile database: {}'.format(mbtiles))
-                    if source_row is None:
-                        continue
-                    flatmap = {
-                        'id': flatmap_dir.name,
-                        'source': source_row[0]
-                    }
-                    created = reader._query("SELECT value FROM metadata WHERE name='created'").fetchone()
-                    if created is not None:
-                        flatmap['created'] = created[0]
-                    describes = reader._query("SELECT value FROM metadata WHERE name='describes'").fetchone()
-                    if describes is not None and describes[0]:
-                        flatmap['describes'] = normalise_identifier(describes[0])
-                flatmap_list.append(flatmap)
-    return quart.jsonify(flatmap_list)
+    url_prefix = f'{quart.request.root_url}{flatmap_blueprint.name}/'
+    listing = await single_flight.run(('maps', url_prefix), run_db, catalogue_listing, url_prefix)
+    return quart.Response(listing, mimetype='application/json')
 
 #===============================================================================
 
@@ -308,7 +584,7 @@ async def markers(map_id):
 @flatmap_blueprint.route('flatmap/<string:map_id>/layers')
 async def map_layers(map_id):
     try:
-        return quart.jsonify(get_metadata(map_id, 'layers'))
+        return quart.Response(await map_metadata_json(map_id, 'layers'), mimetype='application/json')
     except IOError as err:
         quart.abort(404, str(err))
 
@@ -317,7 +593,7 @@ async def map_layers(map_id):
 @flatmap_blueprint.route('flatmap/<string:map_id>/metadata')
 async def map_metadata(map_id):
     try:
-        return quart.jsonify(get_metadata(map_id, 'metadata'))
+        return quart.Response(await map_metadata_json(map_id, 'metadata'), mimetype='application/json')
     except IOError as err:
         quart.abort(404, str(err))
 
@@ -326,7 +602,7 @@ async def map_metadata(map_id):
 @flatmap_blueprint.route('flatmap/<string:map_id>/pathways')
 async def map_pathways(map_id):
     try:
-        return quart.jsonify(get_metadata(map_id, 'pathways'))
+        return quart.Response(await map_metadata_json(map_id, 'pathways'), mimetype='application/json')
     except IOError as err:
         quart.abort(404, str(err))
 
@@ -345,16 +621,15 @@ async def map_background(map_id, image):
 @flatmap_blueprint.route('flatmap/<string:map_id>/mvtiles/<int:z>/<int:x>/<int:y>')
 async def vector_tiles(map_id, z, y, x):
     try:
-        mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, 'index.mbtiles')
-        tile_reader = MBTilesReader(mbtiles)
-        tile_bytes = tile_reader.tile(z, x, y)
-        if read_metadata(tile_reader, 'compressed'):
-            tile_bytes = gzip.decompress(tile_bytes)
-        return await quart.send_file(io.BytesIO(tile_bytes), mimetype='application/octet-stream')
-    except ExtractionError:
-        pass
+        (tile_bytes, gzipped) = await run_db(get_vector_tile, map_id, z, x, y,
+                                             quart.request.accept_encodings.quality('gzip') > 0)
     except (InvalidFormatError, sqlite3.OperationalError):
         quart.abort(404, 'Cannot read tile database')
+    if tile_bytes is not None:
+        headers = {'Vary': 'Accept-Encoding'}
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+        return quart.Response(tile_bytes, mimetype='application/octet-stream', headers=headers)
     return await quart.make_response('', 204)
 
 #===============================================================================
@@ -362,22 +637,19 @@ async def vector_tiles(map_id, z, y, x):
 @flatmap_blueprint.route('flatmap/<string:map_id>/tiles/<string:layer>/<int:z>/<int:x>/<int:y>')
 async def image_tiles(map_id, layer, z, y, x):
     try:
-        mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, '{}.mbtiles'.format(layer))
-        reader = MBTilesReader(mbtiles)
-        image_bytes = io.BytesIO(reader.tile(z, x, y))
-        return await quart.send_file(image_bytes, mimetype='image/png')
-    except ExtractionError:
-        pass
+        image_bytes = await run_db(get_image_tile, map_id, layer, z, x, y)
     except (InvalidFormatError, sqlite3.OperationalError):
         quart.abort(404, 'Cannot read tile database')
-    return await quart.send_file(blank_tile(), mimetype='image/png')
+    if image_bytes is not None:
+        return quart.Response(image_bytes, mimetype='image/png')
+    return quart.Response(await run_cpu(blank_tile), mimetype='image/png')
 
 #===============================================================================
 
 @flatmap_blueprint.route('flatmap/<string:map_id>/annotations')
 async def map_annotation(map_id):
     try:
-        return quart.jsonify(get_metadata(map_id, 'annotations'))
+        return quart.Response(await map_metadata_json(map_id, 'annotations'), mimetype='application/json')
     except IOError as err:
         quart.abort(404, str(err))
 
@@ -386,10 +658,46 @@ async def map_annotation(map_id):
 @flatmap_blueprint.route('flatmap/<string:map_id>/termgraph')
 async def map_termgraph(map_id):
     try:
-        return quart.jsonify(anatomical_hierarchy.get_hierachy(map_id))
+        return quart.Response(await single_flight.run(('termgraph', map_id), run_cpu, termgraph_json, map_id),
+                              mimetype='application/json')
+    except HierarchyNotReady:
+        return hierarchy_unavailable()
     except IOError as err:
         quart.abort(404, str(err))
 
+#===============================================================================
+
+@flatmap_blueprint.route('stats')
+async def server_stats():
+    """
+    Get statistics about the server's caches and executors.
+
+    :>json object executors: the number of ``queued``, ``running`` and ``completed``
+                             jobs for each pool of executor threads
+    :>json object labels: entity label cache ``hits``, ``negativeHits`` of entities
+                          without a label, ``misses``, and the number of cached ``entries``
+    :>json object metadata: map metadata cache ``hits``, ``misses``, and the
+                            number of cached ``entries`` and their total ``bytes``
+    :>json array queries: for each fingerprint of knowledge query SQL, its number of
+                          ``calls``, how many were ``cached``, and its ``totalTime``,
+                          ``meanTime`` and ``maxTime`` in seconds, busiest first
+    :>json object queryResults: knowledge query result cache ``hits``, ``misses``, and the
+                                number of cached ``entries`` and their total ``bytes``
+    :>json object requests: the number of computations ``started`` for requests,
+                            and how many requests ``shared`` an in-flight computation
+    :>json object tiles: tile cache ``hits``, ``misses``, ``evictions``, and the
+                         number of cached ``tiles`` and their total ``bytes``
+    """
+    return quart.jsonify({
+        'executors': executor_stats(),
+        'labels': label_cache.stats,
+        'metadata': metadata_cache.stats,
+        'queries': query_statistics.stats,
+        'queryResults': query_result_cache.stats,
+        'requests': single_flight.stats,
+        'tiles': tile_cache.stats
+    })
+
 #===============================================================================
 #===============================================================================
 
@@ -398,11 +706,49 @@ async def knowledge_label(entity: str):
     """
     Find an entity's label from the flatmap server's knowledge base.
     """
-    knowledge_store = KnowledgeStore(settings['FLATMAP_ROOT'], create=False, read_only=False)
-    label = knowledge_store.label(entity)
-    knowledge_store.close()
+    if (label := label_cache.get(entity)) is None:
+        if (label := await run_db(stored_knowledge_label, entity)) is None:
+            # Look elsewhere without holding up the writer, which only saves
+            # any label that's found
+            label = await run_network(fetched_knowledge_label, entity)
+            if label and label != entity:
+                await run_writer(save_knowledge_labels, {entity: label})
+        label_cache.put(entity, label)
     return quart.jsonify({'entity': entity, 'label': label})
 
+@knowledge_blueprint.route('labels', methods=['POST'])
+async def knowledge_labels():
+    """
+    Find the labels of a list of entities from the flatmap server's knowledge base.
+
+    :<jsonarr string entities: the entities to find labels for, at most ``KNOWLEDGE_LABEL_BATCH``
+
+    :>jsonarr object labels: the ``entity`` and ``label`` of each distinct entity, in order
+    :>json string error: any error message
+    """
+    params = await quart.request.get_json()
+    if (params is None or not isinstance(entities := params.get('entities'), list)
+     or not all(isinstance(entity, str) for entity in entities)):
+        return quart.jsonify({'error': 'No list of entities specified in request'})
+    entities = list(dict.fromkeys(entities))
+    if len(entities) > KNOWLEDGE_LABEL_BATCH:
+        return quart.jsonify({'error': f'At most {KNOWLEDGE_LABEL_BATCH} entities may be specified'})
+    labels = { entity: label for entity in entities if (label := label_cache.get(entity)) is not None }
+    if len(uncached := [entity for entity in entities if entity not in labels]):
+        stored = await run_db(stored_knowledge_labels, uncached)
+        if len(missing := [entity for entity in uncached if entity not in stored]):
+            # Labels not in the knowledge base are looked up concurrently, with
+            # the size of the ``network`` pool limiting how many at once
+            fetched = dict(zip(missing, await asyncio.gather(*[run_network(fetched_knowledge_label, entity)
+                                                               for entity in missing])))
+            stored.update(fetched)
+            await run_writer(save_knowledge_labels, { entity: label for (entity, label) in fetched.items()
+                                                        if label and label != entity })
+        for entity in uncached:
+            label_cache.put(entity, stored[entity])
+        labels.update(stored)
+    return quart.jsonify({'labels': [{'entity': entity, 'label': labels[entity]} for entity in entities]})
+
 @knowledge_blueprint.route('query/', methods=['POST'])
 async def knowledge_query():
     """
@@ -410,26 +756,39 @@ async def knowledge_query():
 
     :<json string sql: SQL code to execute
     :<jsonarr string params: any parameters for the query
+    :<json integer limit: the most rows to return, at most ``KNOWLEDGE_QUERY_ROWS``
+    :<json string cursor: the ``next`` cursor of a previous response to the query
 
     :>json array(string) keys: column names of result values
     :>json array(array(string)) values: result data rows
+    :>json string next: a cursor for getting further rows, if there are any
     :>json string error: any error message
     """
     params = await quart.request.get_json()
-    if params is None or 'sql' not in params:
+    if not isinstance(params, dict) or 'sql' not in params:
         return quart.jsonify({'error': 'No SQL specified in request'})
-    else:
-        knowledge_store = KnowledgeStore(settings['FLATMAP_ROOT'], create=False, read_only=True)
-        result = knowledge_store.query(params.get('sql'), params.get('params', []))
-        knowledge_store.close()
-        if 'error' in result:
-            app.logger.warning('SQL: {}'.format(result['error']))
-        return quart.jsonify(result)
+    sql = params.get('sql')
+    sql_params = params.get('params', [])
+    try:
+        max_rows = max(1, min(int(params.get('limit', KNOWLEDGE_QUERY_ROWS)), KNOWLEDGE_QUERY_ROWS))
+    except (OverflowError, TypeError, ValueError):
+        # JSON numbers such as ``1e999`` are decoded as infinite floats
+        return quart.jsonify({'error': 'Invalid row limit'})
+    offset = 0
+    if (cursor := params.get('cursor')) is not None:
+        if (offset := query_cursor_offset(str(cursor), sql, sql_params)) is None:
+            return quart.jsonify({'error': 'Invalid cursor'})
+    # The query is stopped if the client goes away
+    return quart.Response(stream_in_thread(knowledge_query_json, sql, sql_params,
+                                           max_rows, offset, quart.request.remote_addr),
+                          mimetype='application/json')
 
 @knowledge_blueprint.route('sparcterms')
 async def sparcterms():
-    filename = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY)
-    return await send_json(filename)
+    if not anatomical_hierarchy.ready:
+        return hierarchy_unavailable()
+    return quart.Response(await single_flight.run('sparcterms', run_cpu, anatomical_hierarchy.sparc_terms_json),
+                          mimetype='application/json')
 
 #===============================================================================
 #===============================================================================
@@ -536,7 +895,7 @@ async def viewer_app(filename='index.html'):
 #===============================================================================
 
 # Add annotator routes
-from .annotator import authenticate, unauthenticate
+from .annotator import annotation_stores, authenticate, unauthenticate
 from .annotator import annotated_items, annotations, annotation, add_annotation
 
 #===============================================================================
@@ -547,7 +906,9 @@ app = Quart('mapserver')
 cors_settings = {'allow_origin': '*'}
 app = cors(app, **cors_settings)
 
-annotator_blueprint = cors(annotator_blueprint, **cors_settings)
+# Let clients see how annotation listings are paged
+annotator_blueprint = cors(annotator_blueprint, **cors_settings,
+                           expose_headers=['X-Next-Cursor', 'X-Total-Count'])
 app.register_blueprint(annotator_blueprint)
 
 flatmap_blueprint = cors(flatmap_blueprint, **cors_settings)
@@ -559,10 +920,96 @@ app.register_blueprint(knowledge_blueprint)
 app.register_blueprint(maker_blueprint)
 app.register_blueprint(viewer_blueprint)
 
+#===============================================================================
+
+async def load_anatomical_hierarchy():
+#=====================================
+    # Labels from the knowledge base are cached first, as they are what
+    # label lookups would otherwise find
+    start_time = time.perf_counter()
+    count = await run_db(cache_stored_knowledge_labels)
+    app.logger.info(f'Cached {count} knowledge base labels in {time.perf_counter() - start_time:.2f}s')
+    start_time = time.perf_counter()
+    try:
+        sparc_hierarchy = await run_cpu(anatomical_hierarchy.load)
+    except Exception as error:
+        app.logger.error(f'Cannot load anatomical hierarchy: {error}')
+        return
+    phases = ', '.join([f'{phase} {seconds:.2f}s' for (phase, seconds) in sparc_hierarchy.load_times.items()])
+    app.logger.info(f'Loaded anatomical hierarchy in {time.perf_counter() - start_time:.2f}s ({phases})')
+    count = await run_cpu(label_cache.warm, sparc_hierarchy.labels())
+    app.logger.info(f'Cached {count} anatomical hierarchy labels')
+
+# The tile database of each map whose termgraph we have built, or tried to build
+
+termgraph_map_keys: dict[str, tuple[int, int, int]] = {}
+
+def precompute_termgraphs():
+#===========================
+    """
+    Build and save the termgraph of any new or remade map which doesn't have
+    a current one, so that the first request for it doesn't have to wait.
+    """
+    start_time = time.perf_counter()
+    release_remade_maps()
+    map_catalogue.invalidate()
+    map_catalogue.refresh()
+    map_keys = map_catalogue.map_keys()
+    for map_id in [map_id for map_id in termgraph_map_keys if map_id not in map_keys]:
+        del termgraph_map_keys[map_id]
+    count = 0
+    for (map_id, key) in map_keys.items():
+        if termgraph_map_keys.get(map_id) != key:
+            termgraph_map_keys[map_id] = key
+            try:
+                anatomical_hierarchy.get_hierachy(map_id)
+                count += 1
+            except Exception as error:
+                app.logger.warning(f'Cannot build termgraph for {map_id}: {error}')
+    if count:
+        app.logger.info(f'Checked termgraphs of {count} maps in {time.perf_counter() - start_time:.2f}s')
+
+def schedule_precompute():
+#=========================
+    background_executor.submit(precompute_termgraphs)
+
+def release_remade_maps():
+#=========================
+    """
+    Release the open tile databases, and cached tiles, of maps that have been
+    remade or removed.
+    """
+    for filename in tile_databases.release_changed():
+        tile_cache.invalidate(os.path.basename(os.path.dirname(filename)))
+
+async def check_for_remade_maps():
+#=================================
+    # Maps are made by the main process, so worker processes have to look
+    # for changes themselves
+    while True:
+        await asyncio.sleep(REMADE_MAP_CHECK_INTERVAL)
+        await run_db(release_remade_maps)
+
+remade_map_check: Optional[asyncio.Task] = None
+
+@app.before_serving
+async def start_background_loading():
+    global remade_map_check
+    # Loading the hierarchy can take minutes when it's not cached, so
+    # don't hold up serving tiles while doing so
+    app.add_background_task(load_anatomical_hierarchy)
+    remade_map_check = asyncio.create_task(check_for_remade_maps())
+
+@app.after_serving
+async def stop_background_checks():
+    if remade_map_check is not None:
+        remade_map_check.cancel()
+
 #===============================================================================
 #===============================================================================
 
-def initialise(viewer=False):
+def initialise(viewer=False, maker=None):
+    start_time = time.perf_counter()
     if viewer and not os.path.exists(settings['FLATMAP_VIEWER']):
         exit(f'Missing {settings["FLATMAP_VIEWER"]} directory -- set FLATMAP_VIEWER environment variable to the full path')
     settings['MAP_VIEWER'] = viewer
@@ -571,17 +1018,26 @@ def initialise(viewer=False):
         # Only warn once...
         app.logger.warning('No bearer tokens defined')
     # Open our knowledge base
-    knowledge_store = KnowledgeStore(settings['FLATMAP_ROOT'], create=True)
+    knowledge_store = writer_executor.submit(knowledge_stores.writer).result()
     if knowledge_store.error is not None:
         app.logger.error('{}: {}'.format(knowledge_store.error, knowledge_store.db_name))
+    app.logger.info(f'Opened knowledge base in {time.perf_counter() - start_time:.2f}s')
+    # And our annotation store, creating it if need be
+    writer_executor.submit(annotation_stores.writer).result()
 
     if 'sphinx' not in sys.modules:
-        # Having a Manager prevents Sphinx from exiting and hangs a ``readthedocs``
-        # build
-        from .maker import Manager
-
         global map_maker
-        map_maker = Manager()
+        if maker is not None:
+            # Use a map maker in another process
+            map_maker = maker
+        else:
+            # Having a Manager prevents Sphinx from exiting and hangs a ``readthedocs``
+            # build
+            from .maker import Manager
+            map_maker = Manager(on_map_made=schedule_precompute)
+            # Maps may have been made while we weren't running
+            schedule_precompute()
+    app.logger.info(f'Initialised server in {time.perf_counter() - start_time:.2f}s')
 
 #===============================================================================
 #===============================================================================
@@ -0,0 +1,104 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+from concurrent.futures import Future
+import threading
+from typing import Any, Callable, Hashable
+
+#===============================================================================
+
+class SingleFlight:
+    """
+    Share one computation between concurrent callers asking for the same
+    thing.
+
+    The first caller for a key does the work, with any other caller for the
+    key waiting for, and getting, the same result or exception. Nothing is
+    remembered once the work is done.
+
+    :meth:`call` is for functions called from threads and :meth:`run` for
+    coroutine functions awaited in an event loop.
+    """
+    def __init__(self):
+        self.__calls: dict[Hashable, Future] = {}
+        self.__tasks: dict[Hashable, asyncio.Task] = {}
+        self.__started = 0
+        self.__shared = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'started': self.__started,
+                'shared': self.__shared,
+                'inFlight': len(self.__calls) + len(self.__tasks)
+            }
+
+    def call(self, key: Hashable, func: Callable, *args, **kwds) -> Any:
+    #===================================================================
+        with self.__lock:
+            future = self.__calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.__calls[key] = future
+                self.__started += 1
+            else:
+                self.__shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwds)
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+
+    async def run(self, key: Hashable, func: Callable, *args, **kwds) -> Any:
+    #========================================================================
+        """
+        Await a coroutine function, with concurrent callers for the same key
+        awaiting the same task. The task carries on if a caller is cancelled,
+        so that other callers still get its result.
+        """
+        with self.__lock:
+            task = self.__tasks.get(key)
+            if task is None:
+                task = asyncio.ensure_future(func(*args, **kwds))
+                self.__tasks[key] = task
+                task.add_done_callback(lambda _: self.__finished(key))
+                self.__started += 1
+            else:
+                self.__shared += 1
+        return await asyncio.shield(task)
+
+    def __finished(self, key: Hashable):
+    #===================================
+        with self.__lock:
+            del self.__tasks[key]
+
+#===============================================================================
@@ -0,0 +1,142 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+from typing import AsyncIterator, Callable, Iterable, Iterator
+
+#===============================================================================
+
+from .executor import stream_executor
+
+#===============================================================================
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Encoded output is sent in chunks of about this many bytes
+
+STREAM_CHUNK_SIZE = 64*1024
+
+# How many chunks may be waiting to be sent before we stop reading
+
+STREAM_QUEUE_SIZE = 4
+
+# How long, in seconds, to wait for a client to take more output before
+# giving up on it
+
+STREAM_SEND_TIMEOUT = float(os.environ.get('STREAM_SEND_TIMEOUT', '60'))
+
+#===============================================================================
+
+def buffered(pieces: Iterable[bytes], size: int=STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+#=====================================================================================
+    """
+    Combine small pieces of output into chunks of about ``size`` bytes.
+    """
+    buffer = bytearray()
+    for piece in pieces:
+        buffer.extend(piece)
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if len(buffer):
+        yield bytes(buffer)
+
+def json_items(items: Iterable[bytes], ndjson: bool=False) -> Iterator[bytes]:
+#============================================================================
+    """
+    Join items that are already JSON into a JSON array or newline delimited
+    JSON.
+    """
+    if ndjson:
+        for item in items:
+            yield item + b'\n'
+    else:
+        separator = b'['
+        for item in items:
+            yield separator + item
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+
+#===============================================================================
+
+class StreamStalled(Exception):
+    pass
+
+async def stream_in_thread(func: Callable[..., Iterable[bytes]], *args) -> AsyncIterator[bytes]:
+#==============================================================================================
+    """
+    Send the output of a generator, run in a ``stream`` executor thread so
+    that all of its database access is from the one thread, and so that
+    waiting for a client doesn't hold up a ``db`` thread.
+
+    ``func`` is called as ``func(stopped, *args)``, with ``stopped`` a
+    :class:`threading.Event` that is set if the stream is closed before all
+    output has been sent. Output is read no faster than it is sent, and
+    reading is abandoned if the client takes no output for
+    ``STREAM_SEND_TIMEOUT`` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    chunks: asyncio.Queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def abandon():
+        # Run in the event loop, replacing unsent output with an error
+        while not chunks.empty():
+            chunks.get_nowait()
+        chunks.put_nowait(StreamStalled('Client stopped reading'))
+
+    def put(chunk):
+        future = asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop)
+        try:
+            future.result(STREAM_SEND_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            stopped.set()
+            loop.call_soon_threadsafe(abandon)
+
+    def produce():
+        try:
+            for chunk in buffered(func(stopped, *args)):
+                put(chunk)
+                if stopped.is_set():
+                    return
+        except Exception as exception:
+            if not stopped.is_set():
+                put(exception)
+            return
+        if not stopped.is_set():
+            put(None)
+
+    stream_executor.submit(produce)
+    try:
+        while (chunk := await chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Let the producer see that we have stopped
+        stopped.set()
+        while not chunks.empty():
+            chunks.get_nowait()
+
+#===============================================================================
@@ -0,0 +1,34 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import os
+import tempfile
+
+#===============================================================================
+
+# The server reads its settings, and checks its directories exist, when
+# it's first imported
+
+TEST_ROOT = tempfile.mkdtemp(prefix='mapserver-tests-')
+
+os.environ.setdefault('FLATMAP_ROOT', TEST_ROOT)
+os.environ.setdefault('FLATMAP_SERVER_LOGS', TEST_ROOT)
+
+#===============================================================================
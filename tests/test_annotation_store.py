@@ -0,0 +1,229 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+import json
+import re
+import sqlite3
+
+#===============================================================================
+
+import pytest
+
+#===============================================================================
+
+# The annotator's routes are registered once the server has been imported
+from mapserver.server import app
+from mapserver.annotator import ANNOTATION_STORE_MIGRATIONS, ANNOTATION_STORE_SCHEMA, SESSION_STORE_SCHEMA
+from mapserver.annotator import SESSION_TTL, AnnotationStore, Page, PageError
+
+#===============================================================================
+
+RESOURCE = 'https://example.org/flatmap'
+
+CREATOR = {
+    'name': 'Test User',
+    'email': 'test@example.org',
+    'orcid': '0000-0002-1825-0097',
+}
+
+# Statements that read every row of a table are only allowed a scan when
+# it's through an index, so that rows are in order without being sorted
+
+UNFILTERED = re.compile(r'^\s*select\b(?!.*\bwhere\b)', re.IGNORECASE | re.DOTALL)
+
+# Tables that only ever have one row
+
+SINGLE_ROW_TABLES = ['change_sequence']
+
+#===============================================================================
+
+@pytest.fixture
+def store(tmp_path):
+    store = AnnotationStore(tmp_path / 'annotation_store.db')
+    for n in range(20):
+        store.add_annotation({
+            'resource': RESOURCE,
+            'item': f'item-{n % 5}',
+            'creator': dict(CREATOR, orcid=f'0000-0000-0000-{n % 3:04}'),
+            'created': f'2024-01-{n//2 + 1:02}T00:00:00+00:00',
+            'rdfs:comment': f'Comment {n}',
+            'feature': {'id': f'item-{n % 5}', 'geometry': None, 'properties': {}},
+        })
+    store.save_session('session', {'key': 'value'})
+    yield store
+    store.close()
+
+def traced_statements(store: AnnotationStore) -> list[str]:
+#==========================================================
+    """
+    Every statement run by the store's listings and lookups, with any
+    parameters in place.
+    """
+    statements = []
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    db.set_trace_callback(statements.append)
+    try:
+        for page in [None, Page(3), Page(3, ['item-1'])]:
+            store.annotated_item_ids(RESOURCE, page)
+            store.user_item_ids(RESOURCE, '0000-0000-0000-0001', True, page)
+            store.user_item_ids(RESOURCE, '0000-0000-0000-0001', False, page)
+        for page in [None, Page(3), Page(3, ['item-1', 3])]:
+            store.features(RESOURCE, page)
+            store.item_features(RESOURCE, ['item-1', 'item-2'], page)
+        for page in [None, Page(3)]:
+            store.annotations(page=page)
+            store.annotations(RESOURCE, page=page)
+            store.annotations(RESOURCE, 'item-1', page=page)
+        first = Page(3)
+        store.annotations(page=first)
+        for (resource, item) in [(None, None), (RESOURCE, None), (RESOURCE, 'item-1')]:
+            store.annotations(resource, item, Page(3, first.next))
+        store.annotation(5)
+        store.changes(None, 5, 10)
+        store.changes(RESOURCE, 5, 10)
+        store.session_data('session')
+        store.touch_session('session')
+        store.save_session('other', {})
+        store.add_annotation({
+            'resource': RESOURCE,
+            'item': 'item-1',
+            'creator': CREATOR,
+            'feature': {'id': 'item-1', 'geometry': None, 'properties': {}},
+        })
+        store.delete_session('session')
+    finally:
+        db.set_trace_callback(None)
+    return statements
+
+#===============================================================================
+
+def test_migrated(store):
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    assert db.execute('PRAGMA user_version').fetchone()[0] == len(ANNOTATION_STORE_MIGRATIONS)
+
+def test_session_expiry(store):
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    assert store.session_data('session') == {'key': 'value'}
+    assert store.touch_session('session')
+    db.execute('update sessions set last_used = last_used - ?', (SESSION_TTL + 1,))
+    db.commit()
+    assert store.session_data('session') is None
+    assert not store.touch_session('session')
+    # Expired sessions are removed when a session is started
+    store.save_session('other', {})
+    assert [row[0] for row in db.execute('select session from sessions')] == ['other']
+
+def test_existing_sessions_kept(tmp_path):
+    db_path = tmp_path / 'annotation_store.db'
+    db = sqlite3.connect(db_path)
+    db.executescript(ANNOTATION_STORE_SCHEMA)
+    db.executescript(SESSION_STORE_SCHEMA)
+    db.execute("insert into sessions (session, data) values ('session', '{}')")
+    db.commit()
+    db.close()
+    store = AnnotationStore(db_path)
+    assert store.session_data('session') == {}
+    store.close()
+
+@pytest.mark.parametrize('fields', [
+    {'created': {'bad': 1}},
+    {'item': {'id': {'bad': 1}}},
+    {'item': True},
+    {'resource': ['bad']},
+    {'creator': dict(CREATOR, orcid=1)},
+])
+def test_invalid_annotation(store, fields):
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    annotation = dict({'resource': RESOURCE, 'item': 'item-1', 'creator': dict(CREATOR)}, **fields)
+    assert 'error' in store.add_annotation(annotation)
+    assert not db.in_transaction
+    assert 'annotationId' in store.add_annotation({'resource': RESOURCE, 'item': 'item-1', 'creator': dict(CREATOR)})
+
+def test_failed_annotation_rolled_back(store):
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    counts = lambda: (db.execute('select last from change_sequence').fetchone()[0],
+                      db.execute('select count(*) from annotations').fetchone()[0],
+                      db.execute('select count(*) from features where deleted is null').fetchone()[0])
+    before = counts()
+    db.execute("create temp trigger fail before insert on features begin select raise(abort, 'failed'); end")
+    result = store.add_annotation({
+        'resource': RESOURCE,
+        'item': 'item-1',
+        'creator': dict(CREATOR),
+        'feature': {'id': 'item-1', 'geometry': None, 'properties': {}},
+    })
+    assert result == {'error': 'failed'}
+    assert not db.in_transaction
+    assert counts() == before
+
+@pytest.mark.parametrize('query', ['wait=NaN', 'wait=Infinity', 'wait=-Infinity', 'wait=1e999',
+                                   'wait=true', 'wait=soon', 'since=-1', 'since=1.5', 'since=first'])
+def test_invalid_change_parameters(query):
+    # Parameters are checked before the store is read, so we skip authentication
+    annotation_changes = app.view_functions['annotator.annotation_changes'].__wrapped__
+    async def get():
+        async with app.test_request_context(f'/annotator/changes/?{query}'):
+            (response, status) = await annotation_changes()
+            return (status, await response.get_json())
+    assert asyncio.run(get()) == (400, {'error': 'Invalid change parameters'})
+
+def test_annotation_pages(store):
+    listing = json.loads(store.annotations(RESOURCE))
+    paged = []
+    after = None
+    while True:
+        page = Page(3, after)
+        paged.extend(json.loads(store.annotations(RESOURCE, page=page)))
+        assert page.total == len(listing)
+        if (after := page.next) is None:
+            break
+        # Cursors don't have the creator's details
+        assert len(after) == 2 and isinstance(after[0], str) and isinstance(after[1], int)
+    assert paged == listing
+
+@pytest.mark.parametrize('after', [
+    ['2024-01-01'],
+    ['2024-01-01', '3'],
+    ['2024-01-01', {'name': 'Test User'}, 3],
+    [{'name': 'Test User'}, 3],
+])
+def test_invalid_annotation_cursor(store, after):
+    with pytest.raises(PageError):
+        store.annotations(RESOURCE, page=Page(3, after))
+
+@pytest.mark.parametrize('after', [[], ['item-1', '3'], [['item-1'], 3], ['item-1', True]])
+def test_invalid_feature_cursor(store, after):
+    with pytest.raises(PageError):
+        store.features(RESOURCE, Page(3, after))
+
+def test_query_plans(store):
+    db: sqlite3.Connection = store._AnnotationStore__db     # type: ignore
+    statements = [statement for statement in traced_statements(store)
+                    if statement.split(None, 1)[0].lower() in ['select', 'update', 'delete']]
+    assert len(statements)
+    for statement in statements:
+        plan = [row[3] for row in db.execute(f'explain query plan {statement}')]
+        assert not any('TEMP B-TREE' in step for step in plan), (statement, plan)
+        for step in plan:
+            if step.startswith('SCAN') and step.split()[1] not in SINGLE_ROW_TABLES:
+                assert UNFILTERED.match(statement) and 'INDEX' in step, (statement, plan)
+
+#===============================================================================
@@ -0,0 +1,226 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import itertools
+import os
+from types import SimpleNamespace
+
+#===============================================================================
+
+import networkx as nx
+import pytest
+
+#===============================================================================
+
+import mapserver.knowledge.hierarchy
+from mapserver.knowledge.hierarchy import ANATOMICAL_ROOT, BODY_PROPER, TREE_VERSION
+from mapserver.knowledge.hierarchy import AnatomicalHierarchy, Arborescence, SparcGraph, SparcHierarchy
+from mapserver.knowledge.rdf_utils import Uri
+from mapserver.settings import settings
+
+#===============================================================================
+
+ROOT = ANATOMICAL_ROOT.id
+
+def uberon_graph() -> tuple[nx.DiGraph, dict[str, int]]:
+#=======================================================
+    # A is one step from the root and B three steps
+    graph = nx.DiGraph()
+    graph.add_edge('UBERON:A', ROOT)
+    graph.add_edge('UBERON:B', 'UBERON:B1')
+    graph.add_edge('UBERON:B1', 'UBERON:B2')
+    graph.add_edge('UBERON:B2', ROOT)
+    graph.add_edge('UBERON:C', 'UBERON:C1')
+    graph.add_edge('UBERON:C1', 'UBERON:C2')
+    graph.add_edge('UBERON:C2', ROOT)
+    return (graph, dict(nx.single_target_shortest_path_length(graph, ROOT)))
+
+def add_ilx_child(graph: nx.DiGraph, depths: dict[str, int], ilx):
+#=================================================================
+    hierarchy = SparcHierarchy.__new__(SparcHierarchy)
+    hierarchy._SparcHierarchy__add_ilx_child(graph, depths, ilx)         # type: ignore
+
+def ilx_term(id: str, *parents: str):
+#====================================
+    return SimpleNamespace(uri=Uri(id), label=id, parents=[Uri(p) for p in parents])
+
+def sparc_graph() -> nx.DiGraph:
+#==============================
+    # D reaches the root by paths of two and three steps, and E is unconnected
+    graph = nx.DiGraph()
+    graph.add_node(ROOT, label='anatomical entity')
+    graph.add_node('UBERON:A', label='organ')
+    graph.add_node('UBERON:B', label='organ')
+    graph.add_node('UBERON:C', label='tête')
+    graph.add_node('UBERON:D')
+    graph.add_node('UBERON:E', label='')
+    graph.add_edge('UBERON:A', ROOT)
+    graph.add_edge('UBERON:B', 'UBERON:C')
+    graph.add_edge('UBERON:C', ROOT)
+    graph.add_edge('UBERON:D', 'UBERON:B')
+    graph.add_edge('UBERON:D', 'UBERON:A')
+    return graph
+
+def map_term_graph() -> tuple[nx.DiGraph, dict]:
+#=============================================
+    # Terms with several paths to their parents, of the same and of different
+    # lengths, through terms that aren't on the map, and a term not under the root
+    graph = nx.DiGraph()
+    graph.add_edge(BODY_PROPER.id, ROOT)
+    graph.add_edge('UBERON:1', BODY_PROPER.id)
+    graph.add_edge('UBERON:2', 'UBERON:1')
+    graph.add_edge('UBERON:2', 'UBERON:X')
+    graph.add_edge('UBERON:X', BODY_PROPER.id)
+    graph.add_edge('UBERON:3', 'UBERON:2')
+    graph.add_edge('UBERON:3', 'UBERON:1')
+    graph.add_edge('UBERON:4', 'UBERON:3')
+    graph.add_edge('UBERON:4', 'UBERON:Y')
+    graph.add_edge('UBERON:Y', 'UBERON:Z')
+    graph.add_edge('UBERON:Z', ROOT)
+    graph.add_edge('ILX:6', 'UBERON:3')
+    graph.add_edge('ILX:6', 'UBERON:4')
+    graph.add_edge('UBERON:7', 'UBERON:Y')
+    graph.add_node('UBERON:5')
+    for node in graph:
+        graph.nodes[node]['label'] = f'{node} label'
+    models = [BODY_PROPER.id, 'ILX:6', 'UBERON:4', 'UBERON:2', 'UBERON:7', 'UBERON:5',
+              'UBERON:3', 'UBERON:1', 'UBERON:2', 'UBERON:999', None]
+    annotations = {f'feature-{n}': ({'models': model} if model is not None else {})
+                    for (n, model) in enumerate(models)}
+    return (graph, annotations)
+
+def baseline_term_graph(graph: nx.DiGraph, annotations: dict) -> nx.DiGraph:
+#==========================================================================
+    # How a map's terms were connected before there was an ancestor index,
+    # by searching for a path between every pair of terms
+    def path_length(source: Uri, target: Uri) -> int:
+        try:
+            return nx.shortest_path_length(graph, source.id, target.id)
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return -1
+    hierarchy_graph = nx.DiGraph()
+    hierarchy_graph.add_node(ROOT, label=graph.nodes[ROOT]['label'], distance=0)
+    hierarchy_graph.add_node(BODY_PROPER.id, label=graph.nodes[BODY_PROPER.id]['label'])
+    map_terms = set(Uri(term) for term in [ann.get('models') for ann in annotations.values()]
+                        if term is not None and term in graph)
+    for term in map_terms:
+        if (distance := path_length(term, ANATOMICAL_ROOT)) > 0:
+            hierarchy_graph.add_node(term.id, label=graph.nodes[term.id]['label'], distance=distance)
+    map_terms.add(ANATOMICAL_ROOT)
+    for (source, target) in itertools.permutations(map_terms, 2):
+        if (length := path_length(source, target)) > 0:
+            hierarchy_graph.add_edge(source.id, target.id, parent_distance=length)
+    for term in hierarchy_graph.nodes():
+        edges = sorted(hierarchy_graph.out_edges(term, data='parent_distance'), key=lambda edge: edge[2])
+        for edge in edges:
+            if edge[2] > edges[0][2]:
+                hierarchy_graph.remove_edge(edge[0], edge[1])
+    return hierarchy_graph
+
+#===============================================================================
+
+def test_term_added_for_each_parent():
+    graph, depths = uberon_graph()
+    # ``IlxTerms.term_list()`` yields a term once for each parent row it reads
+    term = ilx_term('ILX:1', 'UBERON:A')
+    add_ilx_child(graph, depths, term)
+    term.parents.append(Uri('UBERON:B'))
+    add_ilx_child(graph, depths, term)
+    assert depths['ILX:1'] == 2
+    assert depths['ILX:1'] == nx.shortest_path_length(graph, 'ILX:1', ROOT)
+
+def test_child_of_term_with_several_parents():
+    graph, depths = uberon_graph()
+    term = ilx_term('ILX:1', 'UBERON:A')
+    add_ilx_child(graph, depths, term)
+    term.parents.append(Uri('UBERON:B'))
+    add_ilx_child(graph, depths, term)
+    # ILX:1 is two steps from the root so C is the furthest parent
+    child = ilx_term('ILX:2', 'ILX:1', 'UBERON:C')
+    add_ilx_child(graph, depths, child)
+    assert list(graph.successors('ILX:2')) == ['UBERON:C']
+    assert depths['ILX:2'] == 4
+
+def test_sparc_graph_round_trip(tmp_path):
+    graph = sparc_graph()
+    filename = str(tmp_path / 'sparc-hierarchy.bin')
+    SparcGraph.save(graph, filename)
+    sparc = SparcGraph(filename)
+    assert len(sparc) == len(graph)
+    saved = sparc.nx_graph()
+    assert list(saved.nodes) == list(graph.nodes)
+    assert list(saved.edges) == list(graph.edges)
+    # Nodes without a label are labelled with their id
+    labels = {node: graph.nodes[node].get('label', node) for node in graph}
+    assert {node: saved.nodes[node]['label'] for node in saved} == labels
+    assert {node: sparc.label(node) for node in graph} == labels
+    assert dict(sparc.labels()) == {node: label for (node, label) in labels.items() if label}
+    for source in graph:
+        lengths = nx.single_source_shortest_path_length(graph, source)
+        assert dict(sparc.ancestors(source)) == {node: length for (node, length) in lengths.items()
+                                                    if node != source}
+        for target in graph:
+            assert sparc.distance(source, target) == lengths.get(target, -1), (source, target)
+    assert sparc.distance('UBERON:D', ROOT) == 2
+    assert 'UBERON:X' not in sparc
+    assert sparc.distance('UBERON:X', ROOT) == -1
+    assert sparc.distance('UBERON:D', 'UBERON:X') == -1
+
+def test_sparc_graph_truncated(tmp_path):
+    filename = tmp_path / 'sparc-hierarchy.bin'
+    SparcGraph.save(sparc_graph(), str(filename))
+    data = filename.read_bytes()
+    filename.write_bytes(data[:-8])
+    with pytest.raises(ValueError):
+        SparcGraph(str(filename))
+    filename.write_bytes(b'SPARCGR0' + data[8:])
+    with pytest.raises(ValueError):
+        SparcGraph(str(filename))
+
+def test_map_hierarchy_unchanged(tmp_path, monkeypatch):
+    (graph, annotations) = map_term_graph()
+    SparcGraph.save(graph, str(tmp_path / 'sparc-hierarchy.bin'))
+    sparc_hierarchy = SparcHierarchy.__new__(SparcHierarchy)
+    sparc_hierarchy._SparcHierarchy__graph = SparcGraph(str(tmp_path / 'sparc-hierarchy.bin'))  # type: ignore
+    hierarchy = AnatomicalHierarchy()
+    hierarchy._AnatomicalHierarchy__sparc_hierarchy = sparc_hierarchy                         # type: ignore
+    # Keep the graph of map terms that the tree is made from
+    term_graphs = []
+    def arborescence(G: nx.DiGraph, root: Uri, contract_to: Uri) -> Arborescence:
+        term_graphs.append(G.copy())
+        return Arborescence(G, root, contract_to)
+    monkeypatch.setattr(mapserver.knowledge.hierarchy, 'Arborescence', arborescence)
+    monkeypatch.setattr(mapserver.knowledge.hierarchy, 'get_metadata', lambda map_id, name: annotations)
+    monkeypatch.setitem(settings, 'FLATMAP_ROOT', str(tmp_path))
+    map_id = 'hierarchy-unchanged'
+    os.makedirs(tmp_path / map_id)
+    map_hierarchy = hierarchy._AnatomicalHierarchy__build_hierarchy(map_id)                     # type: ignore
+
+    baseline = baseline_term_graph(graph, annotations)
+    (term_graph, ) = term_graphs
+    assert list(term_graph.nodes(data=True)) == list(baseline.nodes(data=True))
+    assert list(term_graph.edges(data=True)) == list(baseline.edges(data=True))
+    # UBERON:3 is as close to UBERON:1 as it is to UBERON:2
+    assert set(term_graph.successors('UBERON:3')) == {'UBERON:1', 'UBERON:2'}
+    baseline_tree = Arborescence(baseline, ANATOMICAL_ROOT, BODY_PROPER).tree
+    baseline_tree.graph['version'] = TREE_VERSION       # type: ignore
+    assert map_hierarchy == nx.node_link_data(baseline_tree)
+
+#===============================================================================
@@ -0,0 +1,103 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+import sqlite3
+
+#===============================================================================
+
+import pytest
+
+#===============================================================================
+
+from mapserver.knowledge import QueryRows
+from mapserver.server import app
+
+#===============================================================================
+
+@pytest.fixture
+def databases(tmp_path):
+    db_path = tmp_path / 'knowledgebase.db'
+    writer = sqlite3.connect(db_path)
+    writer.execute('PRAGMA journal_mode=WAL')
+    writer.execute('create table labels (entity text primary key, label text)')
+    writer.execute("insert into labels values ('UBERON:1', 'first')")
+    writer.commit()
+    reader = sqlite3.connect(db_path)
+    yield (reader, writer)
+    reader.close()
+    writer.close()
+
+def query(db: sqlite3.Connection, sql: str) -> tuple[list, QueryRows]:
+#=====================================================================
+    rows = QueryRows(db, sql, [], None, 0, None)
+    return (list(rows), rows)
+
+def post_query(body: str):
+#=========================
+    async def post():
+        response = await app.test_client().post('/knowledge/query/', data=body,
+                                                headers={'Content-Type': 'application/json'})
+        return (response.status_code, await response.get_json())
+    return asyncio.run(post())
+
+#===============================================================================
+
+def test_query(databases):
+    (reader, _) = databases
+    (values, rows) = query(reader, 'select entity, label from labels')
+    assert rows.error is None
+    assert rows.keys == ('entity', 'label')
+    assert values == [('UBERON:1', 'first')]
+
+@pytest.mark.parametrize('sql', ['', 'begin', 'create temp table t(x)'])
+def test_statement_without_rows(databases, sql):
+    (reader, _) = databases
+    (values, rows) = query(reader, sql)
+    assert rows.error is not None
+    assert values == []
+    assert not reader.in_transaction
+
+def test_no_transaction_left_open(databases):
+    (reader, writer) = databases
+    query(reader, 'begin')
+    query(reader, 'select count(*) from labels')
+    writer.execute("insert into labels values ('UBERON:2', 'second')")
+    writer.commit()
+    # The reader sees the change rather than an old snapshot
+    (values, _) = query(reader, 'select count(*) from labels')
+    assert values == [(2,)]
+
+def test_invalid_query(databases):
+    (reader, _) = databases
+    (_, rows) = query(reader, 'select * from missing')
+    assert rows.error is not None and 'missing' in rows.error
+    (_, rows) = query(reader, 'select 1; select 2')
+    assert rows.error is not None
+
+@pytest.mark.parametrize('limit', ['1e999', '-1e999', 'NaN', '"ten"', '[10]', 'null'])
+def test_invalid_row_limit(limit):
+    assert post_query(f'{{"sql": "select 1", "limit": {limit}}}') == (200, {'error': 'Invalid row limit'})
+
+@pytest.mark.parametrize('body', ['{}', '["sql"]', '"sql"'])
+def test_no_sql(body):
+    assert post_query(body) == (200, {'error': 'No SQL specified in request'})
+
+#===============================================================================
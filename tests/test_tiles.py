@@ -0,0 +1,137 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+#===============================================================================
+
+import pytest
+
+#===============================================================================
+
+from mapserver.mbtiles import TileDatabase, file_key, tile_cache, tile_databases
+from mapserver.server import app, release_remade_maps, settings
+
+#===============================================================================
+
+MAP_ID = 'gzipped-tiles'
+
+TILE = b'vector tile'
+
+def make_map(map_id: str, metadata: Optional[str]=None) -> str:
+#==============================================================
+    map_dir = os.path.join(settings['FLATMAP_ROOT'], map_id)
+    os.makedirs(map_dir, exist_ok=True)
+    filename = os.path.join(map_dir, 'index.mbtiles')
+    db = sqlite3.connect(filename)
+    db.execute('create table metadata (name text, value text)')
+    db.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+    db.execute("insert into metadata values ('compressed', 'true')")
+    if metadata is not None:
+        db.execute("insert into metadata values ('metadata', ?)", (metadata,))
+    db.execute('insert into tiles values (0, 0, 0, ?)', (gzip.compress(TILE),))
+    db.commit()
+    db.close()
+    return filename
+
+@pytest.fixture(scope='module')
+def gzipped_map():
+    make_map(MAP_ID)
+    return MAP_ID
+
+def get(path: str, headers: Optional[dict]=None):
+#===============================================
+    async def get_response():
+        response = await app.test_client().get(path, headers=headers)
+        return (response, await response.get_data())
+    return asyncio.run(get_response())
+
+def get_tile(map_id: str, accept_encoding: str):
+#===============================================
+    return get(f'/flatmap/{map_id}/mvtiles/0/0/0', {'Accept-Encoding': accept_encoding})
+
+#===============================================================================
+
+@pytest.mark.parametrize('accept_encoding', ['gzip', 'gzip, deflate', 'br;q=1.0, gzip;q=0.5', '*'])
+def test_gzipped_tile(gzipped_map, accept_encoding):
+    (response, data) = get_tile(gzipped_map, accept_encoding)
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    assert gzip.decompress(data) == TILE
+
+@pytest.mark.parametrize('accept_encoding', ['', 'identity', 'gzip;q=0', 'deflate, gzip;q=0'])
+def test_decompressed_tile(gzipped_map, accept_encoding):
+    (response, data) = get_tile(gzipped_map, accept_encoding)
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert data == TILE
+
+@pytest.mark.parametrize('metadata', ['{"uuid": ', '["uuid"]'])
+def test_invalid_map_metadata(metadata):
+    map_id = f'invalid-metadata-{len(metadata)}'
+    make_map(map_id, metadata)
+    # The map's resources are still served, but without a version to cache them by
+    (response, data) = get(f'/flatmap/{map_id}/layers')
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
+    (response, data) = get_tile(map_id, 'gzip')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+def test_connection_per_thread():
+    filename = make_map('threaded')
+    database = TileDatabase(filename, file_key(filename))
+    barrier = threading.Barrier(4)
+    def read_tile():
+        # Each thread reads before any finishes, so none can reuse another's connection
+        barrier.wait()
+        tile = database.tile(0, 0, 0)
+        barrier.wait()
+        return tile
+    with ThreadPoolExecutor(4) as executor:
+        tiles = list(executor.map(lambda _: read_tile(), range(4)))
+    assert tiles == 4*[gzip.compress(TILE)]
+    # One connection was opened when the database was, and another by each thread
+    assert database.connections == 5
+    # Threads keep using their own connection
+    database.tile(0, 0, 0)
+    assert database.connections == 5
+
+def test_remade_map_released():
+    filename = make_map('remade')
+    assert get_tile('remade', 'gzip')[0].status_code == 200
+    database = tile_databases.get(filename)
+    tiles = tile_cache.stats['tiles']
+    # A map that's been remade by another process
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    release_remade_maps()
+    assert tile_cache.stats['tiles'] == tiles - 1
+    assert tile_databases.get(filename) is not database
+
+#===============================================================================